@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+
+#
+# Author: Jorge Chang
+#
+# See license in LICENSE file.
+#
+# Benchmarks for pipeline hot loops. Each benchmark checks that the new code path produces
+# the same output as the current one, then reports documents / second for both.
+#
+
+import argparse
+import codecs
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
+import bson
+from bson import json_util
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+import encode_util
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json'))
+import codec_util
+import schema_util
+import transform_util
+import walker_util
+from transform_util import error_stream
+
+
+# generate sample documents with nested records, arrays and the common BSON types
+def generate_documents(num_documents):
+  documents = []
+  for i in range(num_documents):
+    document = {}
+    document['_id'] = ObjectId()
+    document['name'] = u"user %s \u00e9" % i
+    document['age'] = random.randint(18, 80)
+    document['score'] = random.random() * 100
+    document['active'] = i % 2 == 0
+    document['created_at'] = datetime.datetime(2016, 1, 1) + datetime.timedelta(seconds=i)
+    document['balance'] = Decimal128("%s.25" % i)
+    document['avatar'] = Binary("\x00\x01\x02" * 10, 0)
+    document['address'] = {"city": "Chicago", "zipcode": 60601 + i, "geo": {"lat": 41.88, "lng": -87.63}}
+    document['hobbies'] = ["reading", "hiking", "sailing"]
+    document['work_history'] = [{"name": "OneFold", "from": 2013, "to": "present"},
+                                {"name": "Acme", "from": 2010, "to": 2013}]
+    documents.append(bson.BSON.encode(document))
+  return documents
+
+
+def run_timed(name, documents, encode):
+  output = StringIO()
+  start = time.time()
+  encode(documents, output)
+  elapsed = time.time() - start
+  print "%-10s %10.0f docs/sec (%.3f sec)" % (name, len(documents) / elapsed, elapsed)
+  return output.getvalue()
+
+
+def encode_json_util(documents, output):
+  output_codec = codecs.getwriter("utf-8")(output)
+  for document in documents:
+    output_codec.write(json_util.dumps(bson.BSON(document).decode()))
+    output_codec.write('\n')
+
+
+def encode_fast(documents, output):
+  for document in documents:
+    output.write(encode_util.dumps(bson.BSON(document).decode()))
+    output.write('\n')
+
+
+def benchmark_extract_encoder(num_documents):
+  documents = generate_documents(num_documents)
+
+  current_output = run_timed("json_util", documents, encode_json_util)
+  fast_output = run_timed("fast", documents, encode_fast)
+
+  if current_output != fast_output:
+    raise Exception("Fast encoder output differs from bson.json_util.dumps output.")
+  print "Outputs are identical."
+
+
+# DataTransformer.clean_data as it was before schema-compiled transform plans: the data type
+# of each value is looked up and dispatched on for every value. Kept as the baseline.
+class DispatchDataTransformer(transform_util.DataTransformer):
+
+  def clean_data(self, data, line, line_num, parent = None, parent_hash_code = None, is_array = False):
+    new_data = {}
+    new_data_fragments = {}
+
+    # create hash code
+    hash_code = hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+    new_data['hash_code'] = hash_code
+
+    if parent_hash_code != None:
+      new_data['parent_hash_code'] = parent_hash_code
+
+    # determine shard key (only for root level).
+    if parent == None:
+      if self.shard_key is not None:
+        shard_value = self.get_shard_value(data, self.shard_key)
+
+        if shard_value is None:
+          print >> error_stream, "Line %i: Invalid shard value. Data: %s" % (line_num, line)
+          return
+
+        new_data_fragments["root/%s" % shard_value] = new_data
+        self.shard_values.append(shard_value)
+      else:
+        new_data_fragments['root'] = new_data
+
+    else:
+      new_data_fragments['root'] = new_data
+
+    if data:
+
+      if is_array:
+        seperator = "."
+      else:
+        seperator = "_"
+
+      for (key, full_key, value) in walker_util.walk(data, parent, seperator):
+
+        if is_array:
+          dict_key = key
+        else:
+          dict_key = full_key
+
+        # check to see if dict is empty - BigQuery doesn't support RECORD data type with no fields
+        if isinstance(value, dict) and len(value) == 0:
+          continue
+
+        # check to see if list is empty - BigQuery doesn't support REPEATED data type with no data
+        if isinstance(value, list) and len(value) == 0:
+          continue
+
+        # print error if data type is not found for this key, and remember its data type for the schema
+        if full_key not in self.schema:
+          print >> error_stream, "Line %i: Couldn't find data type for key %s. Skipping this value. Data: %s" % (
+            line_num, full_key, line)
+          schema_util.merge_fields(self.missing_fields, schema_util.infer_value_schema(full_key, value))
+          continue
+
+        data_type = self.schema[full_key]["data_type"]
+        mode = self.schema[full_key]["mode"]
+
+        data_type_forced = False
+        if 'forced' in self.schema[full_key]:
+          data_type_forced = self.schema[full_key]['forced']
+
+        if data_type == 'record':
+
+            if mode == 'repeated':
+              if not isinstance(value, list):
+                print >> error_stream, "Line %i: Expect repeated record but found %s. Data: %s" % (line_num, value, line)
+                return None
+              else:
+
+                if self.process_array == "child_table":
+                  if full_key not in new_data_fragments:
+                    new_data_fragments[full_key] = []
+
+                  for v in value:
+                    t = self.clean_data(v, line, line_num, full_key, hash_code, True)
+
+                    for fragment, fragment_content in t.iteritems():
+                      if fragment == 'root':
+                        new_data_fragments[full_key].append(fragment_content)
+                      else:
+                        fragment_key = re.sub("[^0-9a-zA-Z_]", '_', fragment).lower()
+                        new_data_fragments[fragment_key] = fragment_content
+
+                else:
+                  new_data[dict_key] = json.dumps(value)
+
+            else:
+              if not isinstance(value, dict):
+                print >> error_stream, "Line %i: Expect record but found %s. Data: %s" % (line_num, value, line)
+                return None
+              else:
+                t = self.clean_data(value, line, line_num, full_key)
+
+                for fragment, fragment_content in t.iteritems():
+                  if fragment == 'root':
+                    fragment_content.pop("hash_code", None)
+                    new_data.update(fragment_content)
+
+                  if isinstance(fragment_content, list):
+                    new_data_fragments[fragment] = fragment_content
+
+        else:
+
+          if value:
+
+            # check if data type mismatch
+            if data_type == 'string':
+
+              if mode == 'repeated':
+                if not isinstance(value, list):
+                  print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
+                    line_num, value, line)
+                  return None
+                else:
+
+                  if self.process_array == "child_table":
+                    if full_key not in new_data_fragments:
+                      new_data_fragments[full_key] = []
+
+                    for v in value:
+                      cleaned_v = unicode(v)
+                      t = {"value": cleaned_v, "parent_hash_code": hash_code}
+                      new_data_fragments[full_key].append(t)
+                  else:
+                    new_data[dict_key] = json.dumps(value)
+
+              else:
+                new_data[dict_key] = unicode(value)
+
+            elif data_type == 'float':
+
+              if mode == 'repeated':
+                if not isinstance(value, list):
+                  print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
+                    line_num, value, line)
+                  return None
+                else:
+
+                  if self.process_array == "child_table":
+                    if full_key not in new_data_fragments:
+                      new_data_fragments[full_key] = []
+
+                    for v in value:
+
+                      cleaned_v = None
+
+                      try:
+                        cleaned_v = float(v)
+                      except ValueError:
+                        if not data_type_forced:
+                          print >> error_stream, "Line %i: Couldn't convert %s to float. Data: %s" % (
+                            line_num, str(value), line)
+                          return None
+
+                      t = {"value": cleaned_v, "parent_hash_code": hash_code}
+                      new_data_fragments[full_key].append(t)
+                  else:
+                    new_data[dict_key] = json.dumps(value)
+
+              else:
+                try:
+                  new_data[dict_key] = float(value)
+                except ValueError:
+                  if data_type_forced:
+                    new_data[dict_key] = None
+                  else:
+                    print >> error_stream, "Line %i: Couldn't convert %s to float. Data: %s" % (
+                      line_num, str(value), line)
+                    return None
+
+            elif data_type == 'integer':
+
+              if mode == 'repeated':
+                if not isinstance(value, list):
+                  print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
+                    line_num, value, line)
+                  return None
+                else:
+
+                  if self.process_array == "child_table":
+                    if full_key not in new_data_fragments:
+                      new_data_fragments[full_key] = []
+
+                    for v in value:
+
+                      cleaned_v = None
+
+                      try:
+                        cleaned_v = int(v)
+                      except ValueError:
+                        if not data_type_forced:
+                          print >> error_stream, "Line %i: Couldn't convert %s to int. Data: %s" % (
+                            line_num, str(value), line)
+                          return None
+
+                      t = {"value": cleaned_v, "parent_hash_code": hash_code}
+                      new_data_fragments[full_key].append(t)
+                  else:
+                    new_data[dict_key] = json.dumps(value)
+
+              else:
+                try:
+                  new_data[dict_key] = int(value)
+                except ValueError:
+                  if data_type_forced:
+                    new_data[dict_key] = None
+                  else:
+                    print >> error_stream, "Line %i: Couldn't convert %s to int. Data: %s" % (line_num, str(value), line)
+                    return None
+
+            elif data_type == 'boolean':
+
+              if mode == 'repeated':
+                if not isinstance(value, list):
+                  print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
+                    line_num, value, line)
+                  return None
+                else:
+
+                  if self.process_array == "child_table":
+                    if full_key not in new_data_fragments:
+                      new_data_fragments[full_key] = []
+
+                    for v in value:
+                      t = {"value": str(v).lower() == 'true', "parent_hash_code": hash_code}
+                      new_data_fragments[full_key].append(t)
+                  else:
+                    new_data[dict_key] = json.dumps(value)
+
+              else:
+                new_data[dict_key] = (str(value).lower() == 'true')
+
+            else:
+
+              if mode == 'repeated':
+                if not isinstance(value, list):
+                  print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
+                    line_num, value, line)
+                  return None
+                else:
+
+                  if self.process_array == "child_table":
+                    if full_key not in new_data_fragments:
+                      new_data_fragments[full_key] = []
+
+                    for v in value:
+                      cleaned_v = unicode(v)
+                      t = {"value": cleaned_v, "parent_hash_code": hash_code}
+                      new_data_fragments[full_key].append(t)
+                  else:
+                    new_data[dict_key] = json.dumps(value)
+
+              else:
+                new_data[dict_key] = unicode(value)
+
+          else:
+            new_data[dict_key] = None
+
+    return new_data_fragments
+
+
+def transform_rows(transformer):
+  def transform(lines, output):
+    for fragment_value, row in transformer.transform(lines):
+      output.write("%s\t%s\n" % (fragment_value, json.dumps(row, sort_keys=True)))
+  return transform
+
+
+def benchmark_transform_plan(num_documents):
+  lines = [encode_util.dumps(bson.BSON(document).decode()) for document in generate_documents(num_documents)]
+
+  fields = schema_util.merge_fields({}, schema_util.generate_schema(lines))
+  schema = {}
+  for key, datatype_mode in fields.iteritems():
+    (data_type, mode) = schema_util.parse_datatype_mode(datatype_mode)
+    schema[key] = {"key": key, "type": "field", "data_type": data_type, "mode": mode}
+  schema['age'] = {"key": 'age', "type": "field", "data_type": "string", "mode": "nullable", "forced": True}
+
+  current_output = run_timed("dispatch", lines, transform_rows(DispatchDataTransformer(schema)))
+  plan_output = run_timed("plan", lines, transform_rows(transform_util.DataTransformer(schema)))
+
+  if current_output != plan_output:
+    raise Exception("Transform plan output differs from per-value dispatch output.")
+  print "Outputs are identical."
+
+
+# documents with mixed-case keys in arrays of records, nested records and arrays
+def generate_columnar_lines(num_documents):
+  lines = []
+  for i in range(num_documents):
+    document = {"userName": "user %s" % i,
+                "Score": random.random() * 100,
+                "phones": [{"phoneNumber": "555-%04d" % i, "Type": "home", "Extension": {"Code": i}},
+                           {"phoneNumber": "556-%04d" % i, "Type": "work", "Tags": ["a", "b"]}],
+                "Address": {"ZipCode": 60601 + i}}
+    lines.append(json.dumps(document))
+  return lines
+
+
+def read_columnar_rows(output_format, file_name):
+  if output_format == 'avro':
+    import fastavro
+    columnar_file = open(file_name, 'rb')
+    rows = list(fastavro.reader(columnar_file))
+    columnar_file.close()
+    return rows
+  else:
+    import pyarrow.parquet
+    table = pyarrow.parquet.read_table(file_name)
+    columns = table.to_pydict()
+    return [dict((column, values[i]) for column, values in columns.iteritems()) for i in range(table.num_rows)]
+
+
+# fragment -> sorted rows of the files written for each fragment. Json keys are matched to columns the
+# way BigQuery does, by the last part of the key and ignoring case, and null columns are left out.
+def read_fragment_rows(tmp_path, output_format):
+  fragment_rows = {}
+  for fragment_value in os.listdir(tmp_path):
+    rows = []
+    for file_name in sorted(os.listdir(os.path.join(tmp_path, fragment_value))):
+      file_name = os.path.join(tmp_path, fragment_value, file_name)
+      if output_format == 'json':
+        for line in open(file_name):
+          rows.append(dict((key.rsplit(".", 1)[-1].lower(), value) for key, value in json.loads(line).iteritems()
+                           if value is not None))
+      else:
+        for row in read_columnar_rows(output_format, file_name):
+          rows.append(dict((key, value) for key, value in row.iteritems() if value is not None))
+    fragment_rows[fragment_value] = sorted(rows)
+  return fragment_rows
+
+
+def write_fragments(transformer, tmp_path, output_format):
+  def write(lines, output):
+    writer = transform_util.create_fragment_writer(tmp_path, transformer.schema, output_format)
+    for fragment_value, row in transformer.transform(lines):
+      writer.write(fragment_value, row)
+    writer.close()
+  return write
+
+
+def benchmark_columnar_output(num_documents):
+  lines = generate_columnar_lines(num_documents)
+
+  fields = schema_util.merge_fields({}, schema_util.generate_schema(lines))
+  schema = {}
+  for key, datatype_mode in fields.iteritems():
+    (data_type, mode) = schema_util.parse_datatype_mode(datatype_mode)
+    schema[key] = {"key": key, "type": "field", "data_type": data_type, "mode": mode}
+  transformer = transform_util.DataTransformer(schema)
+
+  tmp_path = tempfile.mkdtemp()
+  try:
+    run_timed("json", lines, write_fragments(transformer, os.path.join(tmp_path, 'json'), 'json'))
+    json_rows = read_fragment_rows(os.path.join(tmp_path, 'json'), 'json')
+
+    for output_format, module_name in (('avro', 'fastavro'), ('parquet', 'pyarrow')):
+      try:
+        __import__(module_name)
+      except ImportError:
+        print "%s not installed. Skipping %s." % (module_name, output_format)
+        continue
+
+      run_timed(output_format, lines, write_fragments(transformer, os.path.join(tmp_path, output_format), output_format))
+      if read_fragment_rows(os.path.join(tmp_path, output_format), output_format) != json_rows:
+        raise Exception("%s files hold different values than json files." % output_format)
+      print "%s values are identical." % output_format
+  finally:
+    shutil.rmtree(tmp_path)
+
+
+# lines the fast libraries may reject or decode differently: big integers, NaN, raw utf-8, invalid utf-8
+CODEC_EDGE_LINES = ['{"name": "big", "age": 123456789012345678901234567890}',
+                    '{"name": "nan", "score": NaN}',
+                    '{"name": "caf\xc3\xa9", "hobbies": ["\xe2\x82\xac"]}',
+                    '{"name": "invalid \xff\xfe utf-8"}',
+                    'not json']
+
+
+# schema generation and data transform of extracted lines, as run by the mapper scripts
+def run_codec_pipeline(lines, output):
+  fields = schema_util.merge_fields({}, schema_util.generate_schema(lines))
+  schema = {}
+  for key, datatype_mode in sorted(fields.iteritems()):
+    output.write("%s\t%s\n" % (key, datatype_mode))
+    (data_type, mode) = schema_util.parse_datatype_mode(datatype_mode)
+    schema[key] = {"key": key, "type": "field", "data_type": data_type, "mode": mode}
+
+  for fragment_value, row in transform_util.DataTransformer(schema).transform(lines):
+    output.write("%s\t%s\n" % (fragment_value, codec_util.dumps(row)))
+
+
+# same as run_codec_pipeline, with codec_util falling back to the json module
+def run_json_pipeline(lines, output):
+  fast_loads = codec_util.fast_loads
+  codec_util.fast_loads = None
+  try:
+    run_codec_pipeline(lines, output)
+  finally:
+    codec_util.fast_loads = fast_loads
+
+
+def benchmark_json_codec(num_documents):
+  print "JSON codec: loads %s" % codec_util.loads_name
+
+  documents = [bson.BSON(document).decode() for document in generate_documents(num_documents)]
+  lines = [codec_util.dumps(encode_util.json_convert(document)) for document in documents]
+  for line, document in zip(lines, documents):
+    if line != json_util.dumps(document):
+      raise Exception("Extracted line differs from bson.json_util.dumps output: %s" % line)
+  lines.extend(CODEC_EDGE_LINES)
+
+  json_output = run_timed("json", lines, run_json_pipeline)
+  codec_output = run_timed(codec_util.loads_name, lines, run_codec_pipeline)
+
+  if json_output != codec_output:
+    raise Exception("JSON codec output differs from json module output.")
+  print "Outputs are identical."
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark pipeline hot loops.')
+  parser.add_argument('benchmark', metavar='benchmark', type=str, choices=['extract_encoder', 'transform_plan', 'json_codec', 'columnar_output'],
+                      help='Benchmark to run.')
+  parser.add_argument('--num_documents', metavar='num_documents', type=int, default=100000,
+                      help='Number of sample documents. Default is 100000.')
+  args = parser.parse_args()
+
+  if args.benchmark == 'extract_encoder':
+    benchmark_extract_encoder(args.num_documents)
+  elif args.benchmark == 'transform_plan':
+    benchmark_transform_plan(args.num_documents)
+  elif args.benchmark == 'json_codec':
+    benchmark_json_codec(args.num_documents)
+  elif args.benchmark == 'columnar_output':
+    benchmark_columnar_output(args.num_documents)
+
+
+if __name__ == '__main__':
+  main()
@@ -8,7 +8,7 @@
 # like mkdir, rmdir and copy_from_local.
 #
 
-from onefold_util import execute
+from onefold_util import execute, CommandWriter
 
 class CloudStorage:
     
@@ -21,6 +21,10 @@ class CloudStorage:
     def copy_from_local(self, source_local_file_path, dest_path):
         return
 
+    # open a writable stream that uploads directly to dest_file_path
+    def open_writer(self, dest_file_path):
+        return
+
 
 # HDFS implementation.
 class HDFSStorage(CloudStorage):
@@ -33,6 +37,9 @@ class HDFSStorage(CloudStorage):
     
     def copy_from_local(self, source_local_file_path, dest_path):
         execute("hadoop fs -copyFromLocal %s %s/" % (source_local_file_path, dest_path))
+
+    def open_writer(self, dest_file_path):
+        return CommandWriter("hadoop fs -put - %s" % dest_file_path)
         
 
 # Google Cloud Storage implementation.
@@ -70,3 +77,11 @@ class GCloudStorage(CloudStorage):
         
         command = "gsutil -m cp %s gs://%s/%s" % (source_local_file_path, self.bucket_id, dest_path)
         execute(command, ignore_error=False, retry=True)
+
+    def open_writer(self, dest_file_path):
+
+        print 'open_writer: %s' % (dest_file_path)
+
+        # gsutil uploads streams from stdin in chunks using resumable uploads
+        command = "gsutil cp - gs://%s/%s" % (self.bucket_id, dest_file_path)
+        return CommandWriter(command)
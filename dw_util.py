@@ -13,9 +13,76 @@ import abc
 import json
 import pprint
 import re
+import time
 
 from onefold_util import execute, execute_and_read
 
+# partition column of Hive tables partitioned by shard value
+PARTITION_COLUMN_NAME = "onefold_shard"
+
+# storage clause of Hive tables and BigQuery source format, by transformed file format
+HIVE_STORAGE_FORMATS = {'json': "ROW FORMAT SERDE 'com.cloudera.hive.serde.JSONSerDe'",
+                        'avro': "STORED AS AVRO",
+                        'parquet': "STORED AS PARQUET"}
+BIGQUERY_SOURCE_FORMATS = {'json': 'NEWLINE_DELIMITED_JSON',
+                           'avro': 'AVRO',
+                           'parquet': 'PARQUET'}
+
+
+# BigQuery columns with RECORD / REPEATED fields, for process_array "nested". Records are flattened
+# into their parent (e.g. "address_city"), except arrays of records, whose fields are prefixed with
+# the array key and "." (e.g. "phones.number").
+def get_nested_columns(schema_fields):
+
+  columns = []
+
+  # record-repeated key -> RECORD column
+  records = {}
+
+  # parent keys sort before their fields
+  for field in sorted(schema_fields, key=lambda field: field['key']):
+
+    if field['data_type'] == 'record' and field['mode'] != 'repeated':
+      continue
+
+    if "." in field['key']:
+      (parent_key, column_name) = field['key'].rsplit(".", 1)
+      if parent_key not in records:
+        print "  Skipping column %s. Parent %s is not an array of records." % (field['key'], parent_key)
+        continue
+      parent_columns = records[parent_key]['fields']
+    else:
+      column_name = field['key']
+      parent_columns = columns
+
+    if field['data_type'] == 'record':
+      column = {"name": column_name, "type": "record", "mode": "repeated", "fields": []}
+      records[field['key']] = column
+    else:
+      column = {"name": column_name, "type": field['data_type'], "mode": field['mode']}
+
+    parent_columns.append(column)
+
+  return remove_empty_records(columns)
+
+
+# BigQuery requires RECORD columns to have at least one field
+def remove_empty_records(columns):
+  output = []
+  for column in columns:
+    if column['type'] == 'record':
+      column['fields'] = remove_empty_records(column['fields'])
+      if len(column['fields']) == 0:
+        continue
+    output.append(column)
+  return output
+
+# max number of idle HiveServer2 sessions kept open for reuse
+HIVE_MAX_IDLE_SESSIONS = 4
+
+# sessions idle for longer than this (seconds) are checked before reuse
+HIVE_SESSION_CHECK_SECONDS = 60
+
 
 class DataWarehouse:
   __metaclass__ = abc.ABCMeta
@@ -29,7 +96,7 @@ class DataWarehouse:
     return
 
   @abc.abstractmethod
-  def create_table(self, database_name, table_name, schema_fields, process_array):
+  def create_table(self, database_name, table_name, schema_fields, process_array, partitioned):
     return
 
   @abc.abstractmethod
@@ -61,61 +128,78 @@ class DataWarehouse:
     return
 
   @abc.abstractmethod
-  def load_table(self, table_name, file_path):
+  def load_table(self, database_name, table_name, file_path, partition):
     return
 
   @abc.abstractmethod
   def query(self, query):
     return
 
+  # release connections. Nothing to release by default.
+  def close(self):
+    pass
+
+  # raise if a shard value can't be used as partition. Any value can by default.
+  def check_partition(self, partition):
+    pass
+
 
 class Hive(DataWarehouse):
 
   host = None
   port = None
   hive_serdes_path = None
+  output_format = 'json'
+  integer_data_type = 'int'
+  session_pool = None
 
-  def __init__(self, host, port, hive_serdes_path):
+  def __init__(self, host, port, hive_serdes_path, output_format = 'json'):
     print '-- Initializing Hive Util --'
     self.host = host
     self.port = port
     self.hive_serdes_path = hive_serdes_path
+    self.output_format = output_format
+    self.session_pool = HiveSessionPool(host, port, hive_serdes_path)
 
-  def execute_sql (self, database_name, sql, fetch_result = False):
-    import pyhs2
-    conn = pyhs2.connect(host=self.host, port=self.port, authMechanism="NOSASL", database='default')
-
-    # turn on tez and add serde jar
-    c = conn.cursor()
-    c.execute("set hive.execution.engine=tez")
-    c.execute("set hive.cache.expr.evaluation=false")
-    c.execute("add jar %s" % self.hive_serdes_path)
+    # avro / parquet files hold 64 bit integers
+    if output_format != 'json':
+      self.integer_data_type = 'bigint'
 
-    if database_name != None:
-      c.execute("use %s" % database_name)
+  def execute_sql (self, database_name, sql, fetch_result = False):
+    session = self.session_pool.get(database_name)
 
     # run actual command command
     print "Executing HiveQL: %s" % (sql)
-    c.execute(sql)
+    try:
+      session.cursor.execute(sql)
 
-    output = []
-    if fetch_result:
-      rows = c.fetchall()
-      for row in rows:
-        output.append(row)
+      output = []
+      if fetch_result:
+        rows = session.cursor.fetchall()
+        for row in rows:
+          output.append(row)
+    except:
+      # the statement may have failed because the session is broken. Don't reuse it.
+      session.close()
+      raise
 
-    c.close()
-    conn.close()
+    self.session_pool.release(session)
 
     return output
 
+  def close(self):
+    self.session_pool.close()
+
   def create_dataset(self, database_name):
     pass
 
   def delete_dataset(self, database_name):
     pass
 
-  def create_table(self, database_name, table_name, schema_fields, process_array = "child_table"):
+  def create_table(self, database_name, table_name, schema_fields, process_array = "child_table", partitioned = False):
+
+    if process_array == "nested":
+      raise Exception("Hive doesn't support nested process_array. Use child_table or inline.")
 
     # used to keep track of table_name -> column list
     table_columns = {}
@@ -130,7 +214,7 @@ class Hive(DataWarehouse):
       elif field['data_type'] == 'float':
         data_type = 'double'
       elif field['data_type'] ==  'integer':
-        data_type = 'int'
+        data_type = self.integer_data_type
       elif field['data_type'] in ('record'):
         # ignore record
         pass
@@ -167,8 +251,14 @@ class Hive(DataWarehouse):
 
         table_columns[child_table_name].add("`%s` %s" % (column_name, data_type))
 
-    for table_name, columns in table_columns.iteritems():
-      sql = "create table `%s` (%s) ROW FORMAT SERDE 'com.cloudera.hive.serde.JSONSerDe' " % (table_name, ",".join(columns))
+    for child_table_name, columns in table_columns.iteritems():
+
+      # only the main table is partitioned
+      partition_str = ""
+      if partitioned and child_table_name == table_name:
+        partition_str = "PARTITIONED BY (`%s` string) " % PARTITION_COLUMN_NAME
+
+      sql = "create table `%s` (%s) %s%s " % (child_table_name, ",".join(columns), partition_str, HIVE_STORAGE_FORMATS[self.output_format])
       self.execute_sql(database_name, sql)
 
     return table_columns.keys()
@@ -203,7 +293,7 @@ class Hive(DataWarehouse):
       elif field['data_type'] == 'float':
         sql_data_type = 'double'
       elif field['data_type'] ==  'integer':
-        sql_data_type = 'int'
+        sql_data_type = self.integer_data_type
       elif field['data_type'] in ('record'):
         # ignore record
         pass
@@ -264,7 +354,7 @@ class Hive(DataWarehouse):
 
     # create new tables
     for child_table_name, columns in new_table_columns.iteritems():
-      sql = "create table `%s` (%s) ROW FORMAT SERDE 'com.cloudera.hive.serde.JSONSerDe' " % (child_table_name, ",".join(columns))
+      sql = "create table `%s` (%s) %s " % (child_table_name, ",".join(columns), HIVE_STORAGE_FORMATS[self.output_format])
       self.execute_sql(database_name, sql)
 
     return table_names + new_table_columns.keys()
@@ -336,8 +426,10 @@ class Hive(DataWarehouse):
         output.append(row[0])
     return output
 
-  def load_table(self, database_name, table_name, file_path):
+  def load_table(self, database_name, table_name, file_path, partition = None):
     sql = "load data inpath '%s*' into table `%s`" % (file_path, table_name)
+    if partition is not None:
+      sql += " partition (`%s`='%s')" % (PARTITION_COLUMN_NAME, partition)
     self.execute_sql(database_name, sql, fetch_result = False)
 
   def query(self, database_name, query):
@@ -353,16 +445,121 @@ class Hive(DataWarehouse):
     return output
 
 
+# HiveServer2 connection with tez turned on and the serde jar added
+class HiveSession:
+
+  conn = None
+  cursor = None
+  database_name = None
+  last_used = 0
+
+  def __init__(self, host, port, hive_serdes_path):
+    import pyhs2
+    self.conn = pyhs2.connect(host=host, port=port, authMechanism="NOSASL", database='default')
+
+    # turn on tez and add serde jar
+    self.cursor = self.conn.cursor()
+    self.cursor.execute("set hive.execution.engine=tez")
+    self.cursor.execute("set hive.cache.expr.evaluation=false")
+    self.cursor.execute("add jar %s" % hive_serdes_path)
+    self.database_name = 'default'
+    self.last_used = time.time()
+
+  # switch database (default if None), unless already in it
+  def use(self, database_name):
+    if database_name == None:
+      database_name = 'default'
+    if database_name != self.database_name:
+      self.cursor.execute("use %s" % database_name)
+      self.database_name = database_name
+
+  # True if the connection still works. Only checked after the session was idle for a while.
+  def is_alive(self):
+    if time.time() - self.last_used < HIVE_SESSION_CHECK_SECONDS:
+      return True
+    try:
+      self.cursor.execute("set hive.execution.engine=tez")
+      return True
+    except Exception:
+      return False
+
+  def close(self):
+    try:
+      self.cursor.close()
+      self.conn.close()
+    except Exception:
+      # connection may be broken already
+      pass
+
+
+# initialized Hive sessions, reused across statements instead of connecting for each one.
+# Broken sessions are dropped and replaced by new ones.
+class HiveSessionPool:
+
+  host = None
+  port = None
+  hive_serdes_path = None
+  max_idle_sessions = HIVE_MAX_IDLE_SESSIONS
+  idle_sessions = []
+
+  def __init__(self, host, port, hive_serdes_path, max_idle_sessions = HIVE_MAX_IDLE_SESSIONS):
+    self.host = host
+    self.port = port
+    self.hive_serdes_path = hive_serdes_path
+    self.max_idle_sessions = max_idle_sessions
+    self.idle_sessions = []
+
+  # idle session (preferably one already using database_name), or a new one
+  def get(self, database_name):
+    while len(self.idle_sessions) > 0:
+      session = self.idle_sessions.pop()
+      for i, idle_session in enumerate(self.idle_sessions):
+        if idle_session.database_name == database_name:
+          self.idle_sessions[i] = session
+          session = idle_session
+          break
+
+      if session.is_alive():
+        try:
+          session.use(database_name)
+          return session
+        except Exception:
+          pass
+
+      print "Reconnecting broken Hive session."
+      session.close()
+
+    session = HiveSession(self.host, self.port, self.hive_serdes_path)
+    session.use(database_name)
+    return session
+
+  def release(self, session):
+    session.last_used = time.time()
+    if len(self.idle_sessions) < self.max_idle_sessions:
+      self.idle_sessions.append(session)
+    else:
+      session.close()
+
+  def close(self):
+    for session in self.idle_sessions:
+      session.close()
+    self.idle_sessions = []
+
+
 # Implementation for Google BigQuery
 class GBigQuery(DataWarehouse):
 
   project_id = None
   bucket_id = None
+  output_format = 'json'
+  sync_loads = False
 
-  def __init__(self, project_id, bucket_id):
+  def __init__(self, project_id, bucket_id, output_format = 'json', sync_loads = False):
     print '-- Initializing Google BigQuery module --'
     self.project_id = project_id
     self.bucket_id = bucket_id 
+    self.output_format = output_format
+    self.sync_loads = sync_loads
 
   def create_dataset(self, database_name):
     command = "bq --project_id %s mk %s" % (self.project_id, database_name)
@@ -371,10 +568,15 @@ class GBigQuery(DataWarehouse):
   def delete_dataset(self, database_name):
     pass
 
-  def create_table(self, database_name, table_name, schema_fields, process_array = "child_table"):
+  def create_table(self, database_name, table_name, schema_fields, process_array = "child_table", partitioned = False):
     
     table_columns = {}
 
+    # one table with RECORD / REPEATED columns
+    if process_array == "nested":
+      table_columns[table_name] = get_nested_columns(schema_fields)
+      schema_fields = []
+
     for field in schema_fields:
       data_type = field['data_type']
 
@@ -412,18 +614,23 @@ class GBigQuery(DataWarehouse):
 
         table_columns[child_table_name].append({"name": column_name, "type": data_type, "mode": "nullable"})
 
-    for table_name, columns in table_columns.iteritems():
+    for child_table_name, columns in table_columns.iteritems():
 
       # create schema file
-      schema_file_name = table_name + "_schema.json"
+      schema_file_name = child_table_name + "_schema.json"
       schema_json = json.dumps(columns)
       schema_file = open(schema_file_name, "w")
       schema_file.write(schema_json)
       schema_file.close()
 
+      # only the main table is partitioned, by day
+      partition_str = ""
+      if partitioned and child_table_name == table_name:
+        partition_str = "--time_partitioning_type DAY "
+
       # execute create-table command
-      command = "bq --project_id %s mk --schema %s %s.%s" % (self.project_id, schema_file_name,
-                                                             database_name, table_name)
+      command = "bq --project_id %s mk %s--schema %s %s.%s" % (self.project_id, partition_str, schema_file_name,
+                                                               database_name, child_table_name)
       execute(command)
 
     return table_columns.keys()
@@ -478,9 +685,21 @@ class GBigQuery(DataWarehouse):
         output.append(table_name)
     return output
 
-  def load_table(self, database_name, table_name, file_path):
-    command = "bq --project_id %s --nosync load --source_format NEWLINE_DELIMITED_JSON %s.%s gs://%s/%s*" % \
-                  (self.project_id, database_name, table_name, self.bucket_id, file_path)
+  def check_partition(self, partition):
+    if not re.match("^[0-9]{8}$", partition):
+      raise Exception("BigQuery tables are partitioned by day. Shard value %s is not a date (YYYYMMDD)." % partition)
+
+  def load_table(self, database_name, table_name, file_path, partition = None):
+
+    # load into a day partition with a partition decorator
+    if partition is not None:
+      self.check_partition(partition)
+      table_name = "%s$%s" % (table_name, partition)
+
+    # wait for the load job when the caller must know it succeeded (e.g. before saving a checkpoint)
+    sync_option = "" if self.sync_loads else "--nosync "
+    command = "bq --project_id %s %sload --source_format %s '%s.%s' gs://%s/%s*" % \
+                  (self.project_id, sync_option, BIGQUERY_SOURCE_FORMATS[self.output_format], database_name, table_name, self.bucket_id, file_path)
     execute(command)
 
   def query(self, database_name, query):
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+#
+# Author: Jorge Chang
+#
+# See license in LICENSE file.
+#
+# Extraction encoder - turns decoded BSON documents into the same JSON text as
+# bson.json_util.dumps, but converts the document in place, only visits values that
+# are not JSON native and skips the codecs layer (output is always ascii).
+#
+
+import datetime
+import json
+
+import bson
+from bson import json_util
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+# types json.dumps writes the same way json_util does. Non-legacy json modes encode NaN / Infinity specially.
+if json_util.DEFAULT_JSON_OPTIONS.json_mode == json_util.JSONMode.LEGACY:
+  JSON_NATIVE_TYPES = frozenset([unicode, str, int, long, float, bool, type(None)])
+else:
+  JSON_NATIVE_TYPES = frozenset([unicode, str, int, long, bool, type(None)])
+
+
+def convert_objectid(value):
+  return {"$oid": str(value)}
+
+
+def convert_datetime(value):
+  return {"$date": bson._datetime_to_millis(value)}
+
+
+def convert_decimal128(value):
+  return {"$numberDecimal": str(value)}
+
+
+# specialized converters for the most common BSON types. Everything else goes through json_util.
+converters = {}
+converters[ObjectId] = convert_objectid
+converters[Decimal128] = convert_decimal128
+converters[Binary] = json_util.default
+if json_util.DEFAULT_JSON_OPTIONS.datetime_representation == json_util.DatetimeRepresentation.LEGACY:
+  converters[datetime.datetime] = convert_datetime
+else:
+  converters[datetime.datetime] = json_util.default
+
+
+# convert BSON values to JSON-able values. Dicts and lists are converted in place.
+def json_convert(value):
+
+  value_type = type(value)
+
+  if value_type in JSON_NATIVE_TYPES:
+    return value
+
+  if value_type is dict:
+    for k, v in value.iteritems():
+      if type(v) not in JSON_NATIVE_TYPES:
+        value[k] = json_convert(v)
+    return value
+
+  if value_type is list:
+    for i, v in enumerate(value):
+      if type(v) not in JSON_NATIVE_TYPES:
+        value[i] = json_convert(v)
+    return value
+
+  converter = converters.get(value_type)
+  if converter is not None:
+    return converter(value)
+
+  # SON, DBRef, Code, Regex, Timestamp, etc.
+  return json_util._json_convert(value)
+
+
+# same output as bson.json_util.dumps(document). Note: document is modified in place.
+def dumps(document):
+  return json.dumps(json_convert(document))
+
+
+# iterate over documents of a query, decoding a whole raw batch at a time when supported (pymongo 3.6+).
+# sort_by_field None means natural order.
+def find_documents(collection, query, projection, sort_by_field, hint=None, allow_disk_use=False):
+
+  kwargs = {}
+  if allow_disk_use:
+    kwargs['allow_disk_use'] = True
+
+  if hasattr(collection, 'find_raw_batches'):
+    cursor = collection.find_raw_batches(query, projection, **kwargs)
+  else:
+    cursor = collection.find(query, projection, **kwargs)
+
+  if sort_by_field is not None:
+    cursor = cursor.sort(sort_by_field, 1)
+
+  if hint is not None:
+    cursor = cursor.hint(hint)
+
+  if hasattr(collection, 'find_raw_batches'):
+    for batch in cursor:
+      for document in bson.decode_all(batch):
+        yield document
+  else:
+    for document in cursor:
+      yield document
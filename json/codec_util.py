@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+#
+# Author: Jorge Chang
+#
+# See license in LICENSE file.
+#
+# JSON codec - parses lines with ujson when it is installed, falling back to the json module.
+# Works on utf-8 encoded lines, so callers can read and write bytes directly instead of going
+# through codecs readers / writers.
+#
+# Decoded values are the same as json.loads. Lines are always written with json.dumps, since
+# ujson rounds floats when encoding. Hash codes don't use this module, they need the exact
+# json.dumps(sort_keys=True) text.
+#
+
+import json
+
+# name of the library used to decode
+loads_name = 'json'
+
+fast_loads = None
+
+try:
+  import ujson
+
+  # ujson 1.x rounds floats unless precise_float is set. ujson 2+ always parses floats exactly
+  # and no longer accepts the argument.
+  try:
+    ujson.loads('0.1', precise_float=True)
+    fast_loads = lambda line: ujson.loads(line, precise_float=True)
+  except TypeError:
+    fast_loads = ujson.loads
+  loads_name = 'ujson'
+except ImportError:
+  pass
+
+
+# parse a json line (bytes or unicode). Lines ujson rejects (e.g. NaN, integers over 64 bits,
+# invalid utf-8) are parsed again by json.loads, which raises ValueError if the line is not
+# valid json. Invalid utf-8 sequences are dropped, as by a codecs reader with errors="ignore".
+def loads(line):
+  if fast_loads is not None:
+    try:
+      return fast_loads(line)
+    except (ValueError, OverflowError):
+      pass
+
+  try:
+    return json.loads(line, encoding='utf-8')
+  except UnicodeDecodeError:
+    return json.loads(line.decode('utf-8', 'ignore'))
+
+
+# serialize a value to a json string
+def dumps(value):
+  return json.dumps(value)
+
+
+# line as unicode, for error messages. Lines are utf-8 bytes when read without a codecs reader.
+def to_unicode(line):
+  if isinstance(line, str):
+    return line.decode('utf-8', 'ignore')
+  return line
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+#
+# Copyright 2015, OneFold
+# All rights reserved.
+# http://www.onefold.io
+#
+# Author: Jorge Chang
+#
+# See license in LICENSE file.
+#
+# Schema utility - infers field-name -> data-type tuples from documents, folds conflicting
+# data types into the most general one and saves the result to the schema collection.
+# Used by generate-schema-mapper / reducer and by the loader in-process.
+#
+
+import sys
+import codecs
+from collections import OrderedDict
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+import codec_util
+import walker_util
+
+error_stream = codecs.getwriter("utf-8")(sys.stderr)
+
+# max number of schema writes per bulk_write call
+SCHEMA_WRITE_BATCH_SIZE = 1000
+
+# MongoDB error code of unique index violations
+DUPLICATE_KEY_ERROR = 11000
+
+
+def parse_datatype_mode (datatype_mode):
+  a = datatype_mode.split("-")
+  if len(a) >= 2:
+    return (a[0], a[1])
+  else:
+    raise ValueError('Invalid datatype / mode tuple %s' % datatype_mode)
+
+
+def max_datatype_mode (datatype_mode_1, datatype_mode_2):
+
+  if datatype_mode_1 == datatype_mode_2:
+    return datatype_mode_1
+
+  if datatype_mode_1 == 'record-repeated' or datatype_mode_2 == 'record-repeated':
+    return 'record-repeated'
+
+  if datatype_mode_1 == 'string-repeated' or datatype_mode_2 == 'string-repeated':
+    return 'string-repeated'
+
+  if datatype_mode_1 == 'repeated-nullable' or datatype_mode_2 == 'repeated-nullable':
+    return 'repeated-nullable'
+
+  if datatype_mode_1 == 'record-nullable' or datatype_mode_2 == 'record-nullable':
+    return 'record-nullable'
+
+  if datatype_mode_1 == 'string-nullable' or datatype_mode_2 == 'string-nullable':
+    return 'string-nullable'
+
+  if datatype_mode_1 == 'float-nullable' and datatype_mode_2 == 'integer-nullable':
+    return 'float-nullable'
+
+  if datatype_mode_1 == 'integer-nullable' and datatype_mode_2 == 'float-nullable':
+    return 'float-nullable'
+
+  return 'string-nullable'
+
+
+# data type of a scalar value, as the mapper sees it after json.loads. Documents may hold
+# longs (e.g. Int64) that json.loads would give back as int, so check the range instead.
+def scalar_datatype(value):
+  if isinstance(value, bool):
+    return "boolean"
+  elif isinstance(value, (int, long)) and -sys.maxint - 1 <= value <= sys.maxint:
+    return "integer"
+  elif isinstance(value, float):
+    return "float"
+  else:
+    return "string"
+
+
+# generate (key, datatype-mode) tuples for a parsed document
+def infer_schema(data, parent=None, seperator="_"):
+
+  if data:
+
+    for key, full_key, value in walker_util.walk(data, parent, seperator):
+      for t in infer_value_schema(full_key, value):
+        yield t
+
+
+# generate (key, datatype-mode) tuples for a value and its children
+def infer_value_schema(full_key, value):
+
+  if value is None:
+    # if data is Null, PASS.
+    pass
+
+  elif isinstance(value, dict):
+
+    if len(value) > 0:
+      yield (full_key, "record-nullable")
+      for t in infer_schema(value, full_key):
+        yield t
+
+  elif isinstance(value, list):
+
+    for list_value in value:
+      if isinstance(list_value, dict):
+        yield (full_key, "record-repeated")
+        for t in infer_schema(list_value, full_key, "."):
+          yield t
+      else:
+        yield (full_key, scalar_datatype(list_value) + "-repeated")
+
+  else:
+    yield (full_key, scalar_datatype(value) + "-nullable")
+
+
+# structural fingerprint of a parsed document, from its keys and value types. Documents with the
+# same fingerprint infer the same (key, datatype-mode) tuples.
+def fingerprint(data):
+  data_type = type(data)
+  if data_type is dict:
+    return tuple(sorted((key, fingerprint(value)) for key, value in data.iteritems()))
+  elif data_type is list:
+    return (list, frozenset(fingerprint(value) for value in data))
+  else:
+    return data_type
+
+
+# bounded LRU of document fingerprints whose schema has already been inferred
+class ShapeCache:
+
+  max_size = 0
+  fingerprints = None
+  num_hits = 0
+  num_misses = 0
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.fingerprints = OrderedDict()
+    self.num_hits = 0
+    self.num_misses = 0
+
+  # return True if a document with the same shape was seen before, otherwise remember its shape
+  def seen(self, data):
+    f = fingerprint(data)
+    if f in self.fingerprints:
+      # move to most recently used
+      del self.fingerprints[f]
+      self.fingerprints[f] = True
+      self.num_hits += 1
+      return True
+
+    self.fingerprints[f] = True
+    if len(self.fingerprints) > self.max_size:
+      self.fingerprints.popitem(last=False)
+    self.num_misses += 1
+    return False
+
+
+# generate (key, datatype-mode) tuples from lines of json documents.
+# documents whose shape is in shape_cache are skipped.
+def generate_schema(lines, shape_cache=None):
+
+  line_num = 1
+  for line in lines:
+
+    # parse the line
+    try:
+      data = codec_util.loads(line)
+    except ValueError:
+      print >> error_stream, "Line %i: JSON Parse Error. Data: %s" % (line_num, codec_util.to_unicode(line))
+      line_num += 1
+      continue
+
+    if shape_cache is not None and shape_cache.seen(data):
+      line_num += 1
+      continue
+
+    try:
+      for t in infer_schema(data):
+        yield t
+    except Exception:
+      print >> error_stream, "Line %i: Error. Data: %s" % (line_num, codec_util.to_unicode(line))
+
+    line_num += 1
+
+
+# fold (key, datatype-mode) tuples into fields dict (key -> datatype-mode)
+def merge_fields(fields, key_datatype_modes):
+  for key, datatype_mode in key_datatype_modes:
+    if key in fields:
+      fields[key] = max_datatype_mode(fields[key], datatype_mode)
+    else:
+      fields[key] = datatype_mode
+  return fields
+
+
+# merge a list of fields dicts pairwise, in rounds. max_datatype_mode is associative, so the
+# result doesn't depend on how the dicts are grouped.
+def merge_schemas(fields_list):
+  while len(fields_list) > 1:
+    merged = []
+    for i in range(0, len(fields_list) - 1, 2):
+      merged.append(merge_fields(fields_list[i], fields_list[i + 1].iteritems()))
+    if len(fields_list) % 2 == 1:
+      merged.append(fields_list[-1])
+    fields_list = merged
+
+  if len(fields_list) == 0:
+    return {}
+  return fields_list[0]
+
+
+# unique index on field records, so concurrent writers (e.g. mappers saving missing fields) can't insert
+# the same key twice. Fails if the collection already has duplicate field records.
+def create_schema_index(mongo_schema_collection):
+  try:
+    mongo_schema_collection.create_index([("key", ASCENDING), ("type", ASCENDING)], unique=True,
+                                         partialFilterExpression={"type": "field"})
+  except OperationFailure as e:
+    print >> error_stream, "Couldn't create unique index on schema fields: %s" % e
+
+
+# save fields dict (key -> datatype-mode) to schema collection. Existing schema is loaded once
+# and merged in memory, unless the field is forced. Changes are written with bulk writes.
+# New keys are upserted and changed keys are only updated if their record is still the one that
+# was loaded, so concurrent writers don't create duplicate records or overwrite each other. Keys
+# whose write didn't apply are loaded and merged again.
+def save_schema(mongo_schema_collection, fields):
+
+  create_schema_index(mongo_schema_collection)
+
+  keys = sorted(fields)
+  while len(keys) > 0:
+
+    # load existing schema
+    orig_field_records = {}
+    for field_record in mongo_schema_collection.find({"type": "field", "key": {"$in": keys}},
+                                                     {"key": 1, "data_type": 1, "mode": 1, "forced": 1}):
+      orig_field_records[field_record['key']] = field_record
+
+    requests = []
+    written_keys = []
+    for key in keys:
+
+      orig_field_record = orig_field_records.get(key)
+
+      # compare orig data type and save schema to mongodb
+      if orig_field_record is not None:
+
+        if orig_field_record.get('forced') == True:
+          continue
+
+        orig_datatype_mode = orig_field_record['data_type'] + "-" + orig_field_record['mode']
+        new_datatype_mode = max_datatype_mode(orig_datatype_mode, fields[key])
+        if new_datatype_mode == orig_datatype_mode:
+          continue
+
+        (new_datatype, new_mode) = parse_datatype_mode(new_datatype_mode)
+        requests.append(UpdateOne({"key": key, "type": "field", "data_type": orig_field_record['data_type'],
+                                   "mode": orig_field_record['mode']},
+                                  {"$set": {"data_type": new_datatype, "mode": new_mode}}))
+
+      else:
+        (datatype, mode) = parse_datatype_mode(fields[key])
+        requests.append(UpdateOne({"key": key, "type": "field"},
+                                  {"$setOnInsert": {"data_type": datatype, "mode": mode}}, upsert=True))
+
+      written_keys.append(key)
+
+      if len(requests) >= SCHEMA_WRITE_BATCH_SIZE:
+        write_schema_requests(mongo_schema_collection, requests)
+        requests = []
+
+    if len(requests) > 0:
+      write_schema_requests(mongo_schema_collection, requests)
+
+    # written keys are checked again. Keys already up to date are skipped, the others rewritten.
+    keys = written_keys
+
+
+# bulk write schema requests. Duplicate key errors mean another writer inserted the key first;
+# the key is merged again by save_schema.
+def write_schema_requests(mongo_schema_collection, requests):
+  try:
+    mongo_schema_collection.bulk_write(requests, ordered=False)
+  except BulkWriteError as e:
+    for write_error in e.details.get('writeErrors', []):
+      if write_error.get('code') != DUPLICATE_KEY_ERROR:
+        raise
@@ -11,394 +11,29 @@
 #
 # Transform Data Mapper - takes data from stdin, cleans the data based on schema
 # generated previously, and split array fields into different files.
+# Thin CLI wrapper around transform_util for Hadoop streaming / shell pipelines.
 #
 
-import re
 import sys
-import json
-import os
-import socket
-import subprocess
 import codecs
-import hashlib
-import pprint
+import subprocess
 from pymongo import MongoClient
 
-# create utf reader and writer for stdin and stdout
-output_stream = codecs.getwriter("utf-8")(sys.stdout)
-input_stream = codecs.getreader("utf-8")(sys.stdin, errors="ignore")
+import codec_util
+import transform_util
+
+# read and write utf-8 bytes directly; codec_util parses and serializes the lines
+output_stream = sys.stdout
+input_stream = sys.stdin
 error_stream = codecs.getwriter("utf-8")(sys.stderr)
 
 process_array = "child_table"
 shard_key = None
 
-BATCH_SIZE = 10000
-BATCH_NUM_LINES = 50000
-
-# e.g. schema['event'] = 'string-nullable'
-mongo_schema_collection = None
-schema = {}
-shard_values = []
-
 # params
 tmp_path = None
-
-# create file descriptors
-file_descriptors = {}
-
-
-def clean_data(line, line_num, parent = None, parent_hash_code = None, is_array = False):
-  new_data = {}
-  new_data_fragments = {}
-
-  # read each line into a line_hash
-  try:
-    data = json.loads(line, encoding="utf-8")
-  except ValueError:
-    print >> error_stream, "Line %i: JSON Parse Error. Data: %s" % (line_num, line)
-    return None
-
-  # create hash code
-  hash_code = hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
-  new_data['hash_code'] = hash_code
-
-  if parent_hash_code != None:
-    new_data['parent_hash_code'] = parent_hash_code
-
-  # determine shard key (only for root level).
-  if parent == None:
-    if shard_key is not None:
-      shard_value = get_shard_value(data, shard_key)
-
-      if shard_value is None:
-        print >> error_stream, "Line %i: Invalid shard value. Data: %s" % (line_num, line)
-        return
-
-      new_data_fragments["root/%s" % shard_value] = new_data
-      shard_values.append(shard_value)
-    else:
-      new_data_fragments['root'] = new_data
-
-  else:
-    new_data_fragments['root'] = new_data
-
-  if data:
-
-    for (key, value) in data.iteritems():
-
-      k = re.sub("[^0-9a-zA-Z_]", '_', key).lower()
-
-      # BigQuery disallows field to start with number
-      if ord(k[0]) >= 48 and ord(k[0]) <= 59:
-        k = "_f" + k
-
-      # Hive disallows field to start with "_"
-      if k[0] == '_':
-        k = k.lstrip("_")
-
-      if parent == None:
-        full_key = k
-        dict_key = full_key
-      else:
-        if is_array:
-          full_key = parent + "." + k
-          dict_key = key
-        else:
-          full_key = parent + "_" + k
-          dict_key = full_key
-
-      # check to see if dict is empty - BigQuery doesn't support RECORD data type with no fields
-      if isinstance(value, dict) and len(value) == 0:
-        continue
-
-      # check to see if list is empty - BigQuery doesn't support REPEATED data type with no data
-      if isinstance(value, list) and len(value) == 0:
-        continue
-
-      # print error if data type is not found for this key!
-      if full_key not in schema:
-        print >> error_stream, "Line %i: Couldn't find data type for key %s. Skipping this value. Data: %s" % (
-          line_num, full_key, line)
-        continue
-
-      data_type = schema[full_key]["data_type"]
-      mode = schema[full_key]["mode"]
-
-      data_type_forced = False
-      if 'forced' in schema[full_key]:
-        data_type_forced = schema[full_key]['forced']
-
-      if data_type == 'record':
-
-          if mode == 'repeated':
-            if not isinstance(value, list):
-              print >> error_stream, "Line %i: Expect repeated record but found %s. Data: %s" % (line_num, value, line)
-              return None
-            else:
-
-              if process_array == "child_table":
-                if full_key not in new_data_fragments:
-                  new_data_fragments[full_key] = []
-
-                for v in value:
-                  t = clean_data(json.dumps(v, ensure_ascii=False), line_num, full_key, hash_code, True)
-
-                  for fragment, fragment_content in t.iteritems():
-                    if fragment == 'root':
-                      new_data_fragments[full_key].append(fragment_content)
-                    else:
-                      fragment_key = re.sub("[^0-9a-zA-Z_]", '_', fragment).lower()
-                      new_data_fragments[fragment_key] = fragment_content
-
-              else:
-                new_data[dict_key] = json.dumps(value)
-
-          else:
-            if not isinstance(value, dict):
-              print >> error_stream, "Line %i: Expect record but found %s. Data: %s" % (line_num, value, line)
-              return None
-            else:
-              t = clean_data(json.dumps(value, ensure_ascii=False), line_num, full_key)
-
-              for fragment, fragment_content in t.iteritems():
-                if fragment == 'root':
-                  fragment_content.pop("hash_code", None)
-                  new_data.update(fragment_content)
-
-                if isinstance(fragment_content, list):
-                  new_data_fragments[fragment] = fragment_content
-
-      else:
-
-        if value:
-
-          # check if data type mismatch
-          if data_type == 'string':
-
-            if mode == 'repeated':
-              if not isinstance(value, list):
-                print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
-                  line_num, value, line)
-                return None
-              else:
-
-                if process_array == "child_table":
-                  if full_key not in new_data_fragments:
-                    new_data_fragments[full_key] = []
-
-                  for v in value:
-                    cleaned_v = unicode(v)
-                    t = {"value": cleaned_v, "parent_hash_code": hash_code}
-                    new_data_fragments[full_key].append(t)
-                else:
-                  new_data[dict_key] = json.dumps(value)
-
-            else:
-              new_data[dict_key] = unicode(value)
-
-          elif data_type == 'float':
-
-            if mode == 'repeated':
-              if not isinstance(value, list):
-                print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
-                  line_num, value, line)
-                return None
-              else:
-
-                if process_array == "child_table":
-                  if full_key not in new_data_fragments:
-                    new_data_fragments[full_key] = []
-
-                  for v in value:
-
-                    cleaned_v = None
-
-                    try:
-                      cleaned_v = float(v)
-                    except ValueError:
-                      if not data_type_forced:
-                        print >> error_stream, "Line %i: Couldn't convert %s to float. Data: %s" % (
-                          line_num, str(value), line)
-                        return None
-
-                    t = {"value": cleaned_v, "parent_hash_code": hash_code}
-                    new_data_fragments[full_key].append(t)
-                else:
-                  new_data[dict_key] = json.dumps(value)
-
-            else:
-              try:
-                new_data[dict_key] = float(value)
-              except ValueError:
-                if data_type_forced:
-                  new_data[dict_key] = None
-                else:
-                  print >> error_stream, "Line %i: Couldn't convert %s to float. Data: %s" % (
-                    line_num, str(value), line)
-                  return None
-
-          elif data_type == 'integer':
-
-            if mode == 'repeated':
-              if not isinstance(value, list):
-                print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
-                  line_num, value, line)
-                return None
-              else:
-
-                if process_array == "child_table":
-                  if full_key not in new_data_fragments:
-                    new_data_fragments[full_key] = []
-
-                  for v in value:
-
-                    cleaned_v = None
-
-                    try:
-                      cleaned_v = int(v)
-                    except ValueError:
-                      if not data_type_forced:
-                        print >> error_stream, "Line %i: Couldn't convert %s to int. Data: %s" % (
-                          line_num, str(value), line)
-                        return None
-
-                    t = {"value": cleaned_v, "parent_hash_code": hash_code}
-                    new_data_fragments[full_key].append(t)
-                else:
-                  new_data[dict_key] = json.dumps(value)
-
-            else:
-              try:
-                new_data[dict_key] = int(value)
-              except ValueError:
-                if data_type_forced:
-                  new_data[dict_key] = None
-                else:
-                  print >> error_stream, "Line %i: Couldn't convert %s to int. Data: %s" % (line_num, str(value), line)
-                  return None
-
-          elif data_type == 'boolean':
-
-            if mode == 'repeated':
-              if not isinstance(value, list):
-                print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
-                  line_num, value, line)
-                return None
-              else:
-
-                if process_array == "child_table":
-                  if full_key not in new_data_fragments:
-                    new_data_fragments[full_key] = []
-
-                  for v in value:
-                    t = {"value": str(v).lower() == 'true', "parent_hash_code": hash_code}
-                    new_data_fragments[full_key].append(t)
-                else:
-                  new_data[dict_key] = json.dumps(value)
-
-            else:
-              new_data[dict_key] = (str(value).lower() == 'true')
-
-          else:
-
-            if mode == 'repeated':
-              if not isinstance(value, list):
-                print >> error_stream, "Line %i: Expect repeated string but found %s. Data: %s" % (
-                  line_num, value, line)
-                return None
-              else:
-
-                if process_array == "child_table":
-                  if full_key not in new_data_fragments:
-                    new_data_fragments[full_key] = []
-
-                  for v in value:
-                    cleaned_v = unicode(v)
-                    t = {"value": cleaned_v, "parent_hash_code": hash_code}
-                    new_data_fragments[full_key].append(t)
-                else:
-                  new_data[dict_key] = json.dumps(value)
-
-            else:
-              new_data[dict_key] = unicode(value)
-
-        else:
-          new_data[dict_key] = None
-
-  return new_data_fragments
-
-
-def get_shard_value(data, shard_key):
-  # split shard key by "."
-  tmp = data
-  shard_key_parts = shard_key.split(".")
-  for shard_key_part in shard_key_parts:
-    if shard_key_part in tmp:
-      tmp = tmp[shard_key_part]
-    else:
-      return None
-
-  if isinstance(tmp, dict):
-    return None
-  else:
-
-    shard_value = str(tmp)
-
-    if len(shard_value) > 32 or len(shard_value) <= 0:
-      return None
-
-    shard_value = re.sub("[^0-9a-zA-Z_]", '_', shard_value).lower()
-    return shard_value
-
-
-# creating folder and opening file (for local mode)
-def create_file_descriptor(fragment_value, shard_value = None):
-
-  path = fragment_value
-  if shard_value != None:
-    path = fragment_value + "/" + shard_value
-
-  # creating folder and opening file (for local mode)
-  execute('mkdir -p %s/%s' % (tmp_path, path), ignore_error=True)
-  file_name = '%s/%s/part-00000' % (tmp_path, path)
-  print >> error_stream, "Opening file descriptor %s" % file_name
-  file = open(file_name, 'w')
-  file_descriptors[path] = {"file": file, "file_name": file_name}
-  print >> error_stream, "Opened file descriptor %s" % file_name
-
-
-def process_line(line, line_num):
-  # clean data
-  data_fragments = clean_data(line, line_num, None)
-
-  # skip if data is not clean..
-  if data_fragments is None or len(data_fragments) == 0:
-    return
-
-  # handle other fragments
-  for fragment_value, fragment_content in data_fragments.iteritems():
-
-    # open local file descriptor for this fragment (for local mode only)
-    if tmp_path != None:
-      if fragment_value not in file_descriptors:
-        create_file_descriptor(fragment_value)
-      file = file_descriptors[fragment_value]["file"]
-
-    if isinstance(fragment_content, list):
-      for element in fragment_content:
-        if tmp_path != None:
-          # write data to local file
-          file.write(json.dumps(element))
-          file.write('\n')
-        else:
-          print >> output_stream, "%s\t%s" % (fragment_value, json.dumps(element))
-    else:
-      if tmp_path != None:
-        # write data to local file
-        file.write(json.dumps(fragment_content))
-        file.write('\n')
-      else:
-        print >> output_stream, "%s\t%s" % (fragment_value, json.dumps(fragment_content))
+compression = None
+hash_function = "sha1"
 
 
 def execute(command, ignore_error=False):
@@ -412,12 +47,21 @@ def execute(command, ignore_error=False):
 def main(argv):
 
   # parse parameters
-  global tmp_path, mongo_schema_collection
+  global tmp_path, compression, hash_function, shard_key, process_array
 
+  # schema_uri[,tmp_path[,compression[,hash_function[,shard_key[,process_array]]]]]
   args = argv[0].split(",")
   schema_arg = args[0]
-  if len(args) > 1:
+  if len(args) > 1 and len(args[1]) > 0:
     tmp_path = args[1]
+  if len(args) > 2 and len(args[2]) > 0:
+    compression = args[2]
+  if len(args) > 3 and len(args[3]) > 0:
+    hash_function = args[3]
+  if len(args) > 4 and len(args[4]) > 0:
+    shard_key = args[4]
+  if len(args) > 5 and len(args[5]) > 0:
+    process_array = args[5]
 
   schema_args = schema_arg.split("/")
   schema_collection_name = schema_args[-1]
@@ -433,49 +77,30 @@ def main(argv):
   if tmp_path != None:
     execute('rm -rf %s' % tmp_path, ignore_error=True)
 
-  # read schema from MongoDB
-  global schema, process_array, shard_key
-
   # read schema from mongodb server
-  schema_fields = mongo_schema_collection.find({"type": "field"})
-  schema = dict((schema_field['key'], schema_field) for schema_field in schema_fields)
+  schema = transform_util.load_schema(mongo_schema_collection)
 
-  # read process_array from redis
-  # if redis_server.hget('%s/policy' % app_id, "process_array") != None:
-  #   process_array = redis_server.hget('%s/policy' % app_id, "process_array")
-  #
-  # # read shard_key from redis
-  # if redis_server.hget('%s/policy' % app_id, "shard_key") != None:
-  #   shard_key = redis_server.hget('%s/policy' % app_id, "shard_key")
+  transformer = transform_util.DataTransformer(schema, process_array, shard_key, hash_function)
 
-  # process input
-  line_num = 1
-  for line in input_stream:
-    process_line(line, line_num)
-    line_num += 1
-
-    # print something to stderr and stdout every 1000 lines
-    if line_num % 1000 == 0:
-      print >> error_stream, "Processed %i lines." % line_num
-
-  print >> error_stream, "Finished writing to local files."
-
-  # close out the local files
-  for fragment_value, file_descriptor in file_descriptors.iteritems():
-    print >> error_stream, "Closing file descriptor %s" % fragment_value
+  # write to local files (local mode), or fragment\trow to stdout for TransformDataMultiOutputFormat
+  if tmp_path != None:
+    writer = transform_util.FragmentWriter(tmp_path, compression)
+    for fragment_value, row in transformer.transform(input_stream):
+      writer.write(fragment_value, row)
 
-    # close file
-    file_descriptor["file"].close()
+    print >> error_stream, "Finished writing to local files."
+    fragment_values = writer.close()
+  else:
+    fragment_values = set()
+    for fragment_value, row in transformer.transform(input_stream):
+      print >> output_stream, "%s\t%s" % (fragment_value, codec_util.dumps(row))
+      fragment_values.add(fragment_value)
 
-    # write fragment values to mongodb
-    print >> error_stream, "Adding fragment value %s to mongodb." % (fragment_value)
-    mongo_schema_collection.update_one({"type": "fragments"}, {"$addToSet": {"fragments": fragment_value}}, upsert = True);
+  # write fragment values to mongodb
+  transform_util.save_fragments(mongo_schema_collection, fragment_values, shard_key, transformer.shard_values)
 
-  for shard_value in shard_values:
-    # write shard values to mongodb
-    if shard_key is not None:
-      print >> error_stream, "Adding shard value %s to mongodb." % (shard_value)
-      mongo_schema_collection.update_one({"type": "shards"}, {"$addToSet": {"shards": shard_value}}, upsert = True);
+  # write keys missing from the schema to mongodb, so they are loaded on the next run
+  transform_util.save_missing_fields(mongo_schema_collection, transformer.missing_fields)
 
 
 if __name__ == "__main__":
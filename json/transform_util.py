@@ -0,0 +1,797 @@
+#!/usr/bin/env python
+
+#
+# Copyright 2015, OneFold
+# All rights reserved.
+# http://www.onefold.io
+#
+# Author: Jorge Chang
+#
+# See license in LICENSE file.
+#
+# Transform utility - cleans parsed data based on schema generated previously, and splits
+# array fields into fragments. Used by transform-data-mapper and by the loader in-process.
+#
+
+import re
+import sys
+import json
+import os
+import codecs
+import hashlib
+import gzip
+import datetime
+
+import codec_util
+import schema_util
+import walker_util
+
+error_stream = codecs.getwriter("utf-8")(sys.stderr)
+
+# file name extension for each supported compression (local mode only)
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+# read schema from mongodb schema collection, e.g. schema['event'] = {'data_type': 'string', 'mode': 'nullable'}
+def load_schema(mongo_schema_collection):
+  schema_fields = mongo_schema_collection.find({"type": "field"})
+  return dict((schema_field['key'], schema_field) for schema_field in schema_fields)
+
+
+# raised by converters when a value doesn't match its data type. The document is skipped.
+class InvalidValue(Exception):
+  pass
+
+
+def to_boolean(value):
+  return str(value).lower() == 'true'
+
+
+# cast function and type name (for error messages) of each scalar data type. Only float and
+# integer conversion errors are caught.
+SCALAR_CASTS = {'string': (unicode, None),
+                'float': (float, 'float'),
+                'integer': (int, 'int'),
+                'boolean': (to_boolean, None)}
+
+# max number of compiled plans to keep
+PLAN_CACHE_SIZE = 16
+
+# compiled plans by schema fingerprint
+plans = {}
+
+
+# hex digest function of a row hash strategy. sha1 is the default, compatible with existing hash codes.
+# blake2b (hashlib on python 3.6+, or pyblake2) and xxhash are optional.
+def get_hash_function(name):
+  if name == 'sha1':
+    return lambda s: hashlib.sha1(s).hexdigest()
+  elif name == 'blake2b':
+    try:
+      from hashlib import blake2b
+    except ImportError:
+      from pyblake2 import blake2b
+    return lambda s: blake2b(s, digest_size=20).hexdigest()
+  elif name == 'xxhash':
+    import xxhash
+    return lambda s: xxhash.xxh64(s).hexdigest()
+  else:
+    raise ValueError('Unsupported hash function %s' % name)
+
+
+def encode_float(value):
+  if value != value:
+    return 'NaN'
+  elif value == float('inf'):
+    return 'Infinity'
+  elif value == float('-inf'):
+    return '-Infinity'
+  return repr(value)
+
+
+# json encoding of scalar values, same as json.dumps
+SCALAR_ENCODERS = {unicode: json.encoder.encode_basestring_ascii,
+                   str: json.encoder.encode_basestring_ascii,
+                   int: str,
+                   long: str,
+                   float: encode_float,
+                   bool: lambda value: 'true' if value else 'false',
+                   type(None): lambda value: 'null'}
+
+
+# same as json.dumps(value, sort_keys=True), but built bottom-up in one pass, remembering the string
+# of every nested dict in canonical_strings (by id), so nested records don't have to be serialized
+# again. json.dumps can't use its C encoder when sorting keys, which makes this faster too.
+def canonical_json(value, canonical_strings):
+  value_type = type(value)
+
+  if value_type is dict:
+    canonical_string = "{" + ", ".join(json.encoder.encode_basestring_ascii(k) + ": " + canonical_json(v, canonical_strings)
+                                       for k, v in sorted(value.iteritems())) + "}"
+    canonical_strings[id(value)] = canonical_string
+    return canonical_string
+
+  if value_type is list:
+    return "[" + ", ".join(canonical_json(v, canonical_strings) for v in value) + "]"
+
+  encoder = SCALAR_ENCODERS.get(value_type)
+  if encoder is None:
+    return json.dumps(value, sort_keys=True)
+  return encoder(value)
+
+
+# converters below are compiled once per key, and called with
+# (transformer, value, dict_key, new_data, new_data_fragments, hash_code, line, line_num).
+# they write the cleaned value into new_data / new_data_fragments.
+
+def make_nullable_converter(cast, type_name, forced):
+
+  def convert(transformer, value, dict_key, new_data, new_data_fragments, hash_code, line, line_num):
+    if not value:
+      new_data[dict_key] = None
+    elif type_name is None:
+      new_data[dict_key] = cast(value)
+    else:
+      try:
+        new_data[dict_key] = cast(value)
+      except ValueError:
+        if forced:
+          new_data[dict_key] = None
+        else:
+          raise InvalidValue("Couldn't convert %s to %s." % (str(value), type_name))
+
+  return convert
+
+
+def make_repeated_converter(full_key, cast, type_name, forced, process_array):
+
+  def convert(transformer, value, dict_key, new_data, new_data_fragments, hash_code, line, line_num):
+    if not value:
+      new_data[dict_key] = None
+      return
+
+    if not isinstance(value, list):
+      raise InvalidValue("Expect repeated string but found %s." % (value,))
+
+    if process_array == "nested":
+      # REPEATED field of the row. BigQuery doesn't allow NULL in arrays.
+      values = []
+    elif process_array != "child_table":
+      new_data[dict_key] = json.dumps(value)
+      return
+    else:
+      rows = new_data_fragments.setdefault(full_key, [])
+
+    for v in value:
+      if process_array == "nested" and v is None:
+        continue
+
+      if type_name is None:
+        cleaned_v = cast(v)
+      else:
+        cleaned_v = None
+        try:
+          cleaned_v = cast(v)
+        except ValueError:
+          if not forced:
+            raise InvalidValue("Couldn't convert %s to %s." % (str(value), type_name))
+
+      if process_array == "nested":
+        if cleaned_v is not None:
+          values.append(cleaned_v)
+      else:
+        rows.append({"value": cleaned_v, "parent_hash_code": hash_code})
+
+    if process_array == "nested":
+      new_data[dict_key] = values
+
+  return convert
+
+
+def make_record_converter(full_key):
+
+  def convert(transformer, value, dict_key, new_data, new_data_fragments, hash_code, line, line_num):
+    if not isinstance(value, dict):
+      raise InvalidValue("Expect record but found %s." % (value,))
+
+    t = transformer.clean_data(value, line, line_num, full_key)
+
+    for fragment, fragment_content in t.iteritems():
+      if fragment == 'root':
+        fragment_content.pop("hash_code", None)
+        new_data.update(fragment_content)
+
+      if isinstance(fragment_content, list):
+        new_data_fragments[fragment] = fragment_content
+
+  return convert
+
+
+def make_repeated_record_converter(full_key, process_array):
+
+  def convert(transformer, value, dict_key, new_data, new_data_fragments, hash_code, line, line_num):
+    if not isinstance(value, list):
+      raise InvalidValue("Expect repeated record but found %s." % (value,))
+
+    if process_array == "nested":
+      # RECORD REPEATED field of the row. Empty records have no column.
+      rows = []
+      for v in value:
+        row = transformer.clean_data(v, line, line_num, full_key, None, True)['root']
+        if row:
+          rows.append(row)
+      if rows:
+        new_data[dict_key] = rows
+      return
+
+    if process_array != "child_table":
+      new_data[dict_key] = json.dumps(value)
+      return
+
+    rows = new_data_fragments.setdefault(full_key, [])
+    for v in value:
+      t = transformer.clean_data(v, line, line_num, full_key, hash_code, True)
+
+      for fragment, fragment_content in t.iteritems():
+        if fragment == 'root':
+          rows.append(fragment_content)
+        else:
+          fragment_key = re.sub("[^0-9a-zA-Z_]", '_', fragment).lower()
+          new_data_fragments[fragment_key] = fragment_content
+
+  return convert
+
+
+# compile schema into a plan: key -> converter specialized for the key's data type, mode and forced flag
+def compile_plan(schema, process_array):
+  plan = {}
+  for key, field in schema.iteritems():
+    data_type = field["data_type"]
+    mode = field["mode"]
+    forced = bool(field.get('forced', False))
+
+    if data_type == 'record':
+      if mode == 'repeated':
+        plan[key] = make_repeated_record_converter(key, process_array)
+      else:
+        plan[key] = make_record_converter(key)
+    else:
+      # unknown data types are treated as string
+      (cast, type_name) = SCALAR_CASTS.get(data_type, SCALAR_CASTS['string'])
+      if mode == 'repeated':
+        plan[key] = make_repeated_converter(key, cast, type_name, forced, process_array)
+      else:
+        plan[key] = make_nullable_converter(cast, type_name, forced)
+
+  return plan
+
+
+# compiled plan of a schema, cached by schema fingerprint
+def get_plan(schema, process_array):
+  fingerprint = (process_array, tuple(sorted((key, field["data_type"], field["mode"], bool(field.get('forced', False)))
+                                             for key, field in schema.iteritems())))
+  plan = plans.get(fingerprint)
+  if plan is None:
+    plan = compile_plan(schema, process_array)
+    if len(plans) >= PLAN_CACHE_SIZE:
+      plans.clear()
+    plans[fingerprint] = plan
+  return plan
+
+
+class DataTransformer:
+
+  schema = {}
+  plan = {}
+  process_array = "child_table"
+  shard_key = None
+  shard_values = []
+  missing_fields = {}
+  hash_function = None
+  canonical_strings = {}
+
+  def __init__(self, schema, process_array = "child_table", shard_key = None, hash_function = "sha1"):
+    self.schema = schema
+    self.plan = get_plan(schema, process_array)
+    self.process_array = process_array
+    self.shard_key = shard_key
+    self.shard_values = []
+    self.missing_fields = {}
+    self.hash_function = get_hash_function(hash_function)
+    self.canonical_strings = {}
+
+  # hash code of a document, or of a nested record of the document being cleaned
+  def get_hash_code(self, data, parent):
+    if parent == None:
+      self.canonical_strings = {}
+      canonical_string = canonical_json(data, self.canonical_strings)
+    else:
+      canonical_string = self.canonical_strings.get(id(data))
+      if canonical_string is None:
+        canonical_string = canonical_json(data, self.canonical_strings)
+    return self.hash_function(canonical_string)
+
+  # clean parsed data (a document, or a nested record of it). line is only used for error messages.
+  # raises InvalidValue if a value doesn't match its data type.
+  def clean_data(self, data, line, line_num, parent = None, parent_hash_code = None, is_array = False):
+    new_data = {}
+    new_data_fragments = {}
+
+    # create hash code. Nested records (not in an array) only need one as parent of their arrays,
+    # since it is dropped when the record is merged into its parent. Nested rows have no child tables.
+    nested = self.process_array == "nested"
+    hash_code = None
+    if parent == None or (not nested and (is_array or (isinstance(data, dict) and any(isinstance(v, list) for v in data.itervalues())))):
+      hash_code = self.get_hash_code(data, parent)
+      new_data['hash_code'] = hash_code
+
+    if parent_hash_code != None:
+      new_data['parent_hash_code'] = parent_hash_code
+
+    # determine shard key (only for root level).
+    if parent == None:
+      if self.shard_key is not None:
+        shard_value = self.get_shard_value(data, self.shard_key)
+
+        if shard_value is None:
+          print >> error_stream, "Line %i: Invalid shard value. Data: %s" % (line_num, codec_util.to_unicode(line))
+          return
+
+        new_data_fragments["root/%s" % shard_value] = new_data
+        self.shard_values.append(shard_value)
+      else:
+        new_data_fragments['root'] = new_data
+
+    else:
+      new_data_fragments['root'] = new_data
+
+    if data:
+
+      if is_array:
+        seperator = "."
+      else:
+        seperator = "_"
+
+      plan = self.plan
+      for (key, full_key, value) in walker_util.walk(data, parent, seperator):
+
+        if is_array:
+          dict_key = key
+        elif nested:
+          # field name within the enclosing RECORD, e.g. "g_h" for "e.g_h"
+          dict_key = full_key.rsplit(".", 1)[-1]
+        else:
+          dict_key = full_key
+
+        # check to see if dict / list is empty - BigQuery doesn't support RECORD / REPEATED data type with no data
+        if isinstance(value, (dict, list)) and len(value) == 0:
+          continue
+
+        convert = plan.get(full_key)
+
+        # print error if data type is not found for this key, and remember its data type for the schema
+        if convert is None:
+          print >> error_stream, "Line %i: Couldn't find data type for key %s. Skipping this value. Data: %s" % (
+            line_num, full_key, codec_util.to_unicode(line))
+          schema_util.merge_fields(self.missing_fields, schema_util.infer_value_schema(full_key, value))
+          continue
+
+        convert(self, value, dict_key, new_data, new_data_fragments, hash_code, line, line_num)
+
+    return new_data_fragments
+
+  def get_shard_value(self, data, shard_key):
+    # split shard key by "."
+    tmp = data
+    shard_key_parts = shard_key.split(".")
+    for shard_key_part in shard_key_parts:
+      if shard_key_part in tmp:
+        tmp = tmp[shard_key_part]
+      else:
+        return None
+
+    # dates are sharded by day (YYYYMMDD)
+    if isinstance(tmp, dict) and "$date" in tmp:
+      return get_date_shard_value(tmp["$date"])
+
+    if isinstance(tmp, dict):
+      return None
+    else:
+
+      shard_value = str(tmp)
+
+      if len(shard_value) > 32 or len(shard_value) <= 0:
+        return None
+
+      shard_value = re.sub("[^0-9a-zA-Z_]", '_', shard_value).lower()
+      return shard_value
+
+
+  # generate (fragment_value, row) tuples from lines of json documents
+  def transform(self, lines):
+
+    line_num = 1
+    for line in lines:
+
+      # read each line into a line_hash
+      try:
+        data = codec_util.loads(line)
+      except ValueError:
+        print >> error_stream, "Line %i: JSON Parse Error. Data: %s" % (line_num, codec_util.to_unicode(line))
+        line_num += 1
+        continue
+
+      # clean data
+      try:
+        data_fragments = self.clean_data(data, line, line_num, None)
+      except InvalidValue as e:
+        print >> error_stream, "Line %i: %s Data: %s" % (line_num, e.args[0], codec_util.to_unicode(line))
+        data_fragments = None
+      line_num += 1
+
+      # print something to stderr every 1000 lines
+      if line_num % 1000 == 0:
+        print >> error_stream, "Processed %i lines." % line_num
+
+      # skip if data is not clean..
+      if data_fragments is None or len(data_fragments) == 0:
+        continue
+
+      for fragment_value, fragment_content in data_fragments.iteritems():
+        if isinstance(fragment_content, list):
+          for element in fragment_content:
+            yield (fragment_value, element)
+        else:
+          yield (fragment_value, fragment_content)
+
+
+# max number of fragment files open at the same time
+MAX_OPEN_FRAGMENT_FILES = 64
+
+# bytes of rows buffered per fragment before they are written
+FRAGMENT_BUFFER_SIZE = 256 * 1024
+
+# max bytes of rows buffered over all fragments. Once reached, the largest buffers are written
+# until half of it is free.
+FRAGMENT_BUFFER_BUDGET = 64 * 1024 * 1024
+
+
+# YYYYMMDD of a $date value, in any bson json_util representation: millis (legacy),
+# ISO-8601 string (relaxed) or {"$numberLong": millis} (canonical)
+def get_date_shard_value(date_value):
+  if isinstance(date_value, dict) and "$numberLong" in date_value:
+    date_value = int(date_value["$numberLong"])
+
+  if isinstance(date_value, (int, long)):
+    date = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=date_value)
+    return date.strftime("%Y%m%d")
+  elif isinstance(date_value, basestring) and re.match("^[0-9]{4}-[0-9]{2}-[0-9]{2}", date_value):
+    return date_value[0:10].replace("-", "")
+  else:
+    return None
+
+
+# writes rows of each fragment to [tmp_path]/[fragment]/[part_name] (local mode). Rows are buffered per
+# fragment, and at most max_open_files files are kept open; the least recently written one is closed
+# and reopened in append mode when needed (gzip / zstd files then have multiple members / frames).
+class FragmentWriter:
+
+  tmp_path = None
+  compression = None
+  part_name = "part-00000"
+  max_open_files = MAX_OPEN_FRAGMENT_FILES
+  file_names = {}
+  open_files = {}
+  last_used = {}
+  buffers = {}
+  buffer_sizes = {}
+  total_buffer_size = 0
+  buffer_budget = FRAGMENT_BUFFER_BUDGET
+  num_flushes = 0
+
+  def __init__(self, tmp_path, compression = None, part_name = "part-00000", max_open_files = MAX_OPEN_FRAGMENT_FILES,
+               buffer_budget = FRAGMENT_BUFFER_BUDGET):
+    self.tmp_path = tmp_path
+    self.compression = compression
+    self.part_name = part_name
+    self.max_open_files = max_open_files
+    self.file_names = {}
+    self.open_files = {}
+    self.last_used = {}
+    self.buffers = {}
+    self.buffer_sizes = {}
+    self.total_buffer_size = 0
+    self.buffer_budget = buffer_budget
+    self.num_flushes = 0
+
+  # creating folder and opening file, closing the least recently written file if too many are open
+  def open_file(self, fragment_value):
+
+    if len(self.open_files) >= self.max_open_files:
+      lru_fragment_value = min(self.open_files, key=lambda f: self.last_used[f])
+      self.open_files.pop(lru_fragment_value).close()
+
+    file_name = self.file_names.get(fragment_value)
+    if file_name is None:
+      path = '%s/%s' % (self.tmp_path, fragment_value)
+      if not os.path.exists(path):
+        try:
+          os.makedirs(path)
+        except OSError:
+          # another worker process may have just created it
+          if not os.path.isdir(path):
+            raise
+
+      file_name = '%s/%s%s' % (path, self.part_name, COMPRESSION_EXTENSIONS[self.compression])
+      print >> error_stream, "Opening file descriptor %s" % file_name
+      file = open_compressed_file(file_name, self.compression)
+      self.file_names[fragment_value] = file_name
+    else:
+      file = open_compressed_file(file_name, self.compression, append = True)
+
+    self.open_files[fragment_value] = file
+    return file
+
+  def write(self, fragment_value, row):
+    line = codec_util.dumps(row) + '\n'
+    buffer = self.buffers.get(fragment_value)
+    if buffer is None:
+      buffer = self.buffers[fragment_value] = []
+      self.buffer_sizes[fragment_value] = 0
+
+    buffer.append(line)
+    self.buffer_sizes[fragment_value] += len(line)
+    self.total_buffer_size += len(line)
+    if self.buffer_sizes[fragment_value] >= FRAGMENT_BUFFER_SIZE:
+      self.flush(fragment_value)
+    elif self.total_buffer_size >= self.buffer_budget:
+      self.flush_largest()
+
+  # write the largest buffers until half of the buffer budget is free. With many fragments (e.g. one
+  # per day shard), buffers stay small but add up.
+  def flush_largest(self):
+    for fragment_value in sorted(self.buffer_sizes, key=self.buffer_sizes.get, reverse=True):
+      if self.total_buffer_size <= self.buffer_budget // 2:
+        break
+      self.flush(fragment_value)
+
+  # write buffered rows of a fragment
+  def flush(self, fragment_value):
+    file = self.open_files.get(fragment_value)
+    if file is None:
+      file = self.open_file(fragment_value)
+
+    file.write(''.join(self.buffers[fragment_value]))
+    self.total_buffer_size -= self.buffer_sizes[fragment_value]
+    self.buffers[fragment_value] = []
+    self.buffer_sizes[fragment_value] = 0
+
+    self.num_flushes += 1
+    self.last_used[fragment_value] = self.num_flushes
+
+  # flush and close out the local files and return fragment values
+  def close(self):
+    for fragment_value in self.buffers:
+      if len(self.buffers[fragment_value]) > 0:
+        self.flush(fragment_value)
+
+    for fragment_value, file in self.open_files.iteritems():
+      print >> error_stream, "Closing file descriptor %s" % fragment_value
+      file.close()
+    self.open_files = {}
+
+    return self.file_names.keys()
+
+
+# number of rows per avro / parquet file. Each fragment buffers up to this many rows.
+COLUMNAR_ROWS_PER_FILE = 100000
+
+# max number of rows buffered over all fragments. Once reached, the largest buffers are written
+# until half of it is free.
+COLUMNAR_ROWS_BUDGET = 1000000
+
+# file name extension, and avro codec / parquet compression for each supported compression
+COLUMNAR_EXTENSIONS = {'avro': '.avro', 'parquet': '.parquet'}
+AVRO_CODECS = {None: 'null', 'gzip': 'deflate', 'zstd': 'zstandard'}
+PARQUET_COMPRESSIONS = {None: 'none', 'gzip': 'gzip', 'zstd': 'zstd'}
+
+
+# (column name, data type) list of each fragment, e.g. fragment_columns['root'], fragment_columns['address_phones'].
+# same tables and columns as DataWarehouse.create_table with child_table arrays.
+def get_fragment_columns(schema):
+
+  fragment_columns = {'root': [('hash_code', 'string')]}
+
+  for key in sorted(schema):
+    data_type = schema[key]['data_type']
+    if data_type == 'record':
+      continue
+    if data_type not in ('float', 'integer', 'boolean'):
+      data_type = 'string'
+
+    if schema[key]['mode'] == 'repeated':
+      fragment = clean_fragment_value(key)
+      column_name = 'value'
+    elif "." in key:
+      fragment = clean_fragment_value(key.rsplit(".", 1)[0])
+      column_name = key.rsplit(".", 1)[1]
+    else:
+      fragment = 'root'
+      column_name = key
+
+    if fragment not in fragment_columns:
+      fragment_columns[fragment] = [('parent_hash_code', 'string'), ('hash_code', 'string')]
+    fragment_columns[fragment].append((column_name, data_type))
+
+  return fragment_columns
+
+
+# fragment value -> key of fragment_columns. Sharded root fragments (root/[shard value]) are root.
+def clean_fragment_value(fragment_value):
+  if fragment_value.startswith('root/'):
+    return 'root'
+  return re.sub("[^0-9a-zA-Z_]", '_', fragment_value).lower()
+
+
+# writes typed rows of each fragment to [tmp_path]/[fragment]/[part_name]-NNNNN.avro (or .parquet) files
+# (local mode), using the columns of the schema. Rows are buffered per fragment, and each batch of
+# COLUMNAR_ROWS_PER_FILE rows is written to a new file, so no files are kept open.
+class ColumnarFragmentWriter:
+
+  tmp_path = None
+  output_format = 'avro'
+  compression = None
+  part_name = "part-00000"
+  fragment_columns = {}
+  buffers = {}
+  num_files = {}
+  total_rows = 0
+  rows_budget = COLUMNAR_ROWS_BUDGET
+
+  def __init__(self, tmp_path, schema, output_format, compression = None, part_name = "part-00000",
+               rows_budget = COLUMNAR_ROWS_BUDGET):
+    self.tmp_path = tmp_path
+    self.output_format = output_format
+    self.compression = compression
+    self.part_name = part_name
+    self.fragment_columns = get_fragment_columns(schema)
+    self.buffers = {}
+    self.num_files = {}
+    self.total_rows = 0
+    self.rows_budget = rows_budget
+
+  def write(self, fragment_value, row):
+    buffer = self.buffers.get(fragment_value)
+    if buffer is None:
+      buffer = self.buffers[fragment_value] = []
+      self.num_files[fragment_value] = 0
+
+    # array element rows keep the raw document keys (e.g. "phoneNumber"), and records nested in array
+    # elements keep their parent key (e.g. "g.h"), whose last part is the column name
+    for key in row.keys():
+      if "." in key:
+        row[key.rsplit(".", 1)[1]] = row.pop(key)
+      else:
+        column_name = walker_util.clean_key(key)
+        if column_name != key:
+          row[column_name] = row.pop(key)
+
+    buffer.append(row)
+    self.total_rows += 1
+    if len(buffer) >= COLUMNAR_ROWS_PER_FILE:
+      self.flush(fragment_value)
+    elif self.total_rows >= self.rows_budget:
+      self.flush_largest()
+
+  # write the largest buffers until half of the rows budget is free
+  def flush_largest(self):
+    for fragment_value in sorted(self.buffers, key=lambda f: len(self.buffers[f]), reverse=True):
+      if self.total_rows <= self.rows_budget // 2:
+        break
+      self.flush(fragment_value)
+
+  # write buffered rows of a fragment to a new file
+  def flush(self, fragment_value):
+
+    path = '%s/%s' % (self.tmp_path, fragment_value)
+    if not os.path.exists(path):
+      try:
+        os.makedirs(path)
+      except OSError:
+        # another worker process may have just created it
+        if not os.path.isdir(path):
+          raise
+
+    file_name = '%s/%s-%05d%s' % (path, self.part_name, self.num_files[fragment_value], COLUMNAR_EXTENSIONS[self.output_format])
+    print >> error_stream, "Writing %i rows to %s" % (len(self.buffers[fragment_value]), file_name)
+
+    columns = self.fragment_columns[clean_fragment_value(fragment_value)]
+    if self.output_format == 'avro':
+      write_avro_file(file_name, fragment_value, columns, self.buffers[fragment_value], self.compression)
+    else:
+      write_parquet_file(file_name, columns, self.buffers[fragment_value], self.compression)
+
+    self.total_rows -= len(self.buffers[fragment_value])
+    self.buffers[fragment_value] = []
+    self.num_files[fragment_value] += 1
+
+  # write remaining rows and return fragment values
+  def close(self):
+    for fragment_value in self.buffers:
+      if len(self.buffers[fragment_value]) > 0:
+        self.flush(fragment_value)
+    return self.buffers.keys()
+
+
+def write_avro_file(file_name, fragment_value, columns, rows, compression):
+  import fastavro
+
+  avro_types = {'string': 'string', 'float': 'double', 'integer': 'long', 'boolean': 'boolean'}
+  avro_schema = {"type": "record",
+                 "name": clean_fragment_value(fragment_value),
+                 "fields": [{"name": column_name, "type": ["null", avro_types[data_type]], "default": None}
+                            for (column_name, data_type) in columns]}
+
+  avro_file = open(file_name, 'wb')
+  fastavro.writer(avro_file, fastavro.parse_schema(avro_schema), rows, codec=AVRO_CODECS[compression])
+  avro_file.close()
+
+
+def write_parquet_file(file_name, columns, rows, compression):
+  import pyarrow
+  import pyarrow.parquet
+
+  arrow_types = {'string': pyarrow.string(), 'float': pyarrow.float64(), 'integer': pyarrow.int64(), 'boolean': pyarrow.bool_()}
+  arrays = []
+  for (column_name, data_type) in columns:
+    arrays.append(pyarrow.array([row.get(column_name) for row in rows], type=arrow_types[data_type]))
+
+  table = pyarrow.Table.from_arrays(arrays, [column_name for (column_name, data_type) in columns])
+  pyarrow.parquet.write_table(table, file_name, compression=PARQUET_COMPRESSIONS[compression])
+
+
+# writer of transformed rows for an output format: json (FragmentWriter), avro or parquet (ColumnarFragmentWriter)
+def create_fragment_writer(tmp_path, schema, output_format = 'json', compression = None, part_name = "part-00000"):
+  if output_format == 'json':
+    return FragmentWriter(tmp_path, compression, part_name)
+  elif output_format in COLUMNAR_EXTENSIONS:
+    return ColumnarFragmentWriter(tmp_path, schema, output_format, compression, part_name)
+  else:
+    raise ValueError('Unsupported output format %s' % output_format)
+
+
+# open file for writing (or appending), optionally wrapped in a gzip or zstd compressed stream
+def open_compressed_file(file_name, compression, append = False):
+  if append:
+    mode = 'ab'
+  else:
+    mode = 'wb'
+
+  if compression == 'gzip':
+    return gzip.open(file_name, mode)
+  elif compression == 'zstd':
+    import zstandard
+    return zstandard.ZstdCompressor().stream_writer(open(file_name, mode))
+  else:
+    return open(file_name, mode)
+
+
+# save data types of keys missing from the schema (e.g. schema generated from a sample),
+# so the schema heals itself on the next run
+def save_missing_fields(mongo_schema_collection, missing_fields):
+  if len(missing_fields) > 0:
+    print >> error_stream, "Adding %i missing fields to schema: %s" % (len(missing_fields), ', '.join(sorted(missing_fields)))
+    schema_util.save_schema(mongo_schema_collection, missing_fields)
+
+
+# write fragment values (and shard values) to mongodb
+def save_fragments(mongo_schema_collection, fragment_values, shard_key = None, shard_values = []):
+
+  for fragment_value in fragment_values:
+    print >> error_stream, "Adding fragment value %s to mongodb." % (fragment_value)
+    mongo_schema_collection.update_one({"type": "fragments"}, {"$addToSet": {"fragments": fragment_value}}, upsert = True)
+
+  for shard_value in set(shard_values):
+    if shard_key is not None:
+      print >> error_stream, "Adding shard value %s to mongodb." % (shard_value)
+      mongo_schema_collection.update_one({"type": "shards"}, {"$addToSet": {"shards": shard_value}}, upsert = True)
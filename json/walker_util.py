@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+#
+# Author: Jorge Chang
+#
+# See license in LICENSE file.
+#
+# Walker utility - iterates over keys of parsed documents and turns document keys into
+# column names. Shared by schema_util and transform_util.
+#
+
+import re
+
+# max number of raw key -> column name mappings to remember
+KEY_CACHE_SIZE = 100000
+
+column_names = {}
+
+
+# turn document key into column name
+def sanitize_key(key):
+
+  k = re.sub("[^0-9a-zA-Z_]", '_', key).lower()
+
+  # BigQuery disallows field to start with non alpha
+  if ord(k[0]) >= 48 and ord(k[0]) <= 59:
+    k = "_f" + k
+
+  # Hive disallows field to start with "_"
+  if k[0] == '_':
+    k = k.lstrip("_")
+
+  return k
+
+
+# same as sanitize_key, memoized. Documents share few distinct keys, so the cache is
+# simply cleared when full.
+def clean_key(key):
+  column_name = column_names.get(key)
+  if column_name is None:
+    column_name = sanitize_key(key)
+    if len(column_names) >= KEY_CACHE_SIZE:
+      column_names.clear()
+    column_names[key] = column_name
+  return column_name
+
+
+# generate (key, full_key, value) tuples for a parsed document. full_key is the column name
+# of the key, prefixed with parent column name and seperator.
+def walk(data, parent=None, seperator="_"):
+  for key, value in data.iteritems():
+    if parent == None:
+      yield (key, clean_key(key), value)
+    else:
+      yield (key, parent + seperator + clean_key(key), value)
@@ -8,20 +8,47 @@
 # This is the main program used to ETL mongodb collections into Hive tables.
 #
 
-from pymongo import MongoClient
+from pymongo import MongoClient, CursorType, ReadPreference
+from pymongo.errors import OperationFailure
 import argparse
 import os
 import glob
-from bson.json_util import dumps
-import codecs
+import time
+import multiprocessing
 import pprint
 import json
-from onefold_util import execute
+import re
+import sys
+import encode_util
+from bson.decimal128 import Decimal128
+from onefold_util import execute, open_compressed_file, open_compressed_input, CompressedStreamWriter, COMPRESSION_EXTENSIONS
 from dw_util import Hive, GBigQuery
 from cs_util import HDFSStorage, GCloudStorage
 
-
-NUM_RECORDS_PER_PART = 100000
+# modules shared with the mapper / reducer scripts live next to them in json/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json'))
+import codec_util
+import schema_util
+import transform_util
+import walker_util
+
+
+PART_SIZE_BYTES = 128 * 1024 * 1024
+NUM_BOUNDARY_SAMPLES_PER_RANGE = 1000
+FOLLOW_BATCH_SIZE = 100000
+FOLLOW_BATCH_SECONDS = 300
+FOLLOW_MAX_AWAIT_TIME_MS = 1000
+
+# server error codes meaning change streams aren't available: unknown $changeStream stage (before 3.6),
+# not a replica set / sharded cluster, command not supported (e.g. some hosted deployments)
+CHANGE_STREAM_UNSUPPORTED_CODES = frozenset([40324, 40573, 115])
+
+# read preferences for extraction
+READ_PREFERENCES = {'primary': ReadPreference.PRIMARY,
+                    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+                    'secondary': ReadPreference.SECONDARY,
+                    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+                    'nearest': ReadPreference.NEAREST}
 TMP_PATH = '/tmp/onefold_mongo'
 CLOUD_STORAGE_PATH = 'onefold_mongo'
 HADOOP_MAPREDUCE_STREAMING_LIB = "/usr/hdp/current/hadoop-mapreduce-client/hadoop-streaming.jar"
@@ -35,6 +62,10 @@ mapreduce_params["mapred.map.max.attempts"] = "0"
 mapreduce_params["mapred.task.timeout"] = "12000000"
 MAPREDUCE_PARAMS_STR = ' '.join(["-D %s=%s"%(k,v) for k,v in mapreduce_params.iteritems()])
 
+# hadoop codecs used to compress MR output
+HADOOP_COMPRESSION_CODECS = {'gzip': 'org.apache.hadoop.io.compress.GzipCodec',
+                             'zstd': 'org.apache.hadoop.io.compress.ZStandardCodec'}
+
 
 # helper function to split "[datatype]-[mode]" into datatype and mode
 def parse_datatype_mode (datatype_mode):
@@ -56,6 +87,290 @@ def jsonpath_get(mydict, path):
   return elem
 
 
+# writes lines into numbered part files. A new part is started once the current one has
+# part_size_bytes (uncompressed) or part_max_records lines. If cs (cloud storage) is given,
+# parts are uploaded as they are written instead of going to local disk.
+class PartFileWriter:
+
+  def __init__(self, folder, file_prefix, compression, part_size_bytes, part_max_records, cs = None):
+    self.cs = cs
+    self.folder = folder
+    self.file_prefix = file_prefix
+    self.compression = compression
+    self.part_size_bytes = part_size_bytes
+    self.part_max_records = part_max_records
+
+    self.file = None
+    self.part_num = 0
+    self.part_bytes = 0
+    self.part_records = 0
+    self.file_names = []
+    self.part_sizes = []
+
+  def write(self, line):
+
+    # open a new file if necessary
+    if self.file is None or self.part_bytes >= self.part_size_bytes or \
+        (self.part_max_records is not None and self.part_records >= self.part_max_records):
+      self.close()
+
+      self.part_num += 1
+      file_name = "%s/%s%s%s" % (self.folder, self.file_prefix, self.part_num, COMPRESSION_EXTENSIONS[self.compression])
+      if self.cs is not None:
+        self.file = CompressedStreamWriter(self.cs.open_writer(file_name), self.compression)
+      else:
+        self.file = open_compressed_file(file_name, self.compression)
+      self.file_names.append(file_name)
+      print "Creating file %s" % file_name
+
+    self.file.write(line)
+    self.file.write('\n')
+    self.part_bytes += len(line) + 1
+    self.part_records += 1
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.part_sizes.append(self.part_bytes)
+      self.file = None
+      self.part_bytes = 0
+      self.part_records = 0
+
+
+# write documents into part files (and rejected documents into reject files).
+def write_extract_files(documents, params):
+
+  collection_sort_by_field = params['collection_sort_by_field']
+  tmp_path = params['tmp_path']
+  collection_name = params['collection_name']
+
+  # stream to cloud storage, or write to local tmp_path
+  if params['cs'] is not None:
+    folder = "%s/%s" % (CLOUD_STORAGE_PATH, collection_name)
+  else:
+    folder = os.path.join(tmp_path, collection_name)
+
+  extract_writer = PartFileWriter("%s/data" % folder, params['file_prefix'], params['compression'],
+                                  params['part_size_bytes'], params['part_max_records'], params['cs'])
+  reject_writer = PartFileWriter("%s/rejected" % folder, params['file_prefix'], params['compression'],
+                                 params['part_size_bytes'], params['part_max_records'], params['cs'])
+
+  result = {}
+  result['num_records_extracted'] = 0
+  result['num_records_rejected'] = 0
+  result['sort_by_field_min'] = None
+  result['sort_by_field_max'] = None
+  result['schema_fields'] = {}
+
+  shape_cache = None
+  if params['schema_shape_cache_size'] > 0:
+    shape_cache = schema_util.ShapeCache(params['schema_shape_cache_size'])
+
+  for data in documents:
+
+    # track min and max id for auditing..
+    if params['sorted']:
+      # documents without the sort-by field sort first
+      if result['sort_by_field_min'] == None:
+        result['sort_by_field_min'] = data.get(collection_sort_by_field)
+      result['sort_by_field_max'] = data.get(collection_sort_by_field)
+    else:
+      value = data.get(collection_sort_by_field)
+      if value is not None:
+        if result['sort_by_field_min'] == None or value < result['sort_by_field_min']:
+          result['sort_by_field_min'] = value
+        if result['sort_by_field_max'] == None or value > result['sort_by_field_max']:
+          result['sort_by_field_max'] = value
+
+    # validate policies
+    rejected = False
+    for required_field_name, policy in params['required_fields'].iteritems():
+      if policy['required'] and jsonpath_get(data, required_field_name) is None:
+
+        # --------------------------------------------------------
+        # document found that doesn't contain required fields.
+        # --------------------------------------------------------
+
+        result['num_records_rejected'] += 1
+        reject_line = "Rejected. Missing %s. Data: %s" % (required_field_name, encode_util.dumps(data))
+        reject_writer.write(reject_line.encode('utf-8'))
+
+        rejected = True
+        break
+
+    if not rejected:
+      result['num_records_extracted'] += 1
+      # json is utf-8 (ascii with the json module), so no need for a utf-8 codec
+      extract_writer.write(codec_util.dumps(encode_util.json_convert(data)))
+
+      # infer schema from the (now json-converted) document while it is in memory
+      if params['schema_gen_mode'] == 'inline' and (shape_cache is None or not shape_cache.seen(data)):
+        try:
+          schema_util.merge_fields(result['schema_fields'], schema_util.infer_schema(data))
+        except Exception:
+          print "Error inferring schema. Data: %s" % encode_util.dumps(data)
+
+  extract_writer.close()
+  reject_writer.close()
+
+  result['extract_file_names'] = extract_writer.file_names
+  result['extract_part_sizes'] = extract_writer.part_sizes
+  result['reject_file_names'] = reject_writer.file_names
+
+  return result
+
+
+# prefix the fields of a query with "fullDocument." to match change stream events.
+# operators other than $and / $or / $nor apply to the whole event and can't be prefixed.
+def get_change_stream_query(query):
+  change_query = {}
+  for key, value in query.iteritems():
+    if key in ('$and', '$or', '$nor'):
+      change_query[key] = [get_change_stream_query(q) for q in value]
+    elif key.startswith('$'):
+      raise ValueError("Query operator %s is not supported in follow mode." % key)
+    else:
+      change_query["fullDocument.%s" % key] = value
+  return change_query
+
+
+# True if an index can serve the sort on its leading key over all documents. Hashed, text, geo, etc.
+# indexes can't serve a range sort. Sparse and partial indexes don't hold every document, so hinting
+# them would skip documents, and non-simple collations sort strings differently from the query.
+def is_sort_index(index_info):
+  if index_info['key'][0][1] not in (1, -1):
+    return False
+  if index_info.get('sparse') or 'partialFilterExpression' in index_info:
+    return False
+  collation = index_info.get('collation')
+  if collation is not None and collation.get('locale') != 'simple':
+    return False
+  return True
+
+
+# source collection with the requested read preference, e.g. to extract from secondaries
+def get_source_collection(mongo_client, db_name, collection_name, read_preference):
+  return mongo_client[db_name].get_collection(collection_name, read_preference=READ_PREFERENCES[read_preference])
+
+
+# combine query with [lower_bound, upper_bound) range of the sort-by field. None means unbounded.
+# MongoDB only compares values of the same type, so the first range (no lower_bound) is everything
+# not >= upper_bound: it also holds documents whose sort-by field is missing, null or of another type
+# than the boundaries. Boundaries must all be of the same type (see get_boundary_samples).
+def get_range_query(query, collection_sort_by_field, lower_bound, upper_bound):
+
+  range_query = {}
+  if lower_bound is not None:
+    range_query["$gte"] = lower_bound
+    if upper_bound is not None:
+      range_query["$lt"] = upper_bound
+  elif upper_bound is not None:
+    range_query["$not"] = {"$gte": upper_bound}
+
+  if len(range_query) > 0:
+    if query is not None:
+      query = {"$and": [query, {collection_sort_by_field: range_query}]}
+    else:
+      query = {collection_sort_by_field: range_query}
+
+  return query
+
+
+# values MongoDB compares with each other: all numbers, all strings, otherwise same type
+def get_type_bracket(value):
+  if isinstance(value, bool):
+    return bool
+  if isinstance(value, (int, long, float, Decimal128)):
+    return 'number'
+  if isinstance(value, basestring):
+    return 'string'
+  return type(value)
+
+
+# sorted sort-by field samples of the most common type bracket, to compute range boundaries from.
+# Arrays and documents aren't used, since they compare element by element.
+def get_boundary_samples(samples):
+  counts = {}
+  for value in samples:
+    bracket = get_type_bracket(value)
+    counts[bracket] = counts.get(bracket, 0) + 1
+
+  if len(counts) == 0:
+    return []
+
+  bracket = max(counts, key=counts.get)
+  if bracket in (list, dict):
+    return []
+  return [value for value in samples if get_type_bracket(value) == bracket]
+
+
+# extract one range of the source collection into part files. Runs in a worker process
+# for parallel extraction, so it opens its own mongo client and only takes picklable params.
+def extract_partition(params):
+
+  collection_sort_by_field = params['collection_sort_by_field']
+
+  # start mongo client
+  mongo_client = MongoClient(params['mongo_uri'])
+  collection = get_source_collection(mongo_client, params['db_name'], params['collection_name'], params['read_preference'])
+
+  # restrict query to this range
+  query = get_range_query(params['extract_query_json'], collection_sort_by_field,
+                          params['lower_bound'], params['upper_bound'])
+
+  # query collection, sort by collection_sort_by_field
+  if params['sorted']:
+    sort_by_field = collection_sort_by_field
+  else:
+    sort_by_field = None
+
+  documents = encode_util.find_documents(collection, query, params['projection'], sort_by_field,
+                                         params['hint'], params['allow_disk_use'])
+  result = write_extract_files(documents, params)
+
+  mongo_client.close()
+
+  return result
+
+
+# infer schema of one extracted part file. Runs in a worker process for parallel schema generation.
+def generate_part_schema(params):
+
+  print "Generating schema for file %s" % params['file_name']
+
+  shape_cache = None
+  if params['schema_shape_cache_size'] > 0:
+    shape_cache = schema_util.ShapeCache(params['schema_shape_cache_size'])
+
+  part_file = open_compressed_input(params['file_name'], params['compression'])
+  fields = schema_util.merge_fields({}, schema_util.generate_schema(part_file, shape_cache))
+  part_file.close()
+
+  return fields
+
+
+# transform one extracted part file into [tmp_path]/[fragment]/[part_name]. Runs in a worker
+# process for parallel data transform.
+def transform_part(params):
+
+  print "Transforming file %s" % params['file_name']
+
+  transformer = transform_util.DataTransformer(params['schema'], params['process_array'], params['shard_key'], params['hash_function'])
+  writer = transform_util.create_fragment_writer(params['tmp_path'], params['schema'], params['output_format'],
+                                                 params['compression'], params['part_name'])
+
+  part_file = open_compressed_input(params['file_name'], params['compression'])
+  for fragment_value, row in transformer.transform(part_file):
+    writer.write(fragment_value, row)
+  part_file.close()
+
+  result = {}
+  result['fragment_values'] = writer.close()
+  result['shard_values'] = transformer.shard_values
+  result['missing_fields'] = transformer.missing_fields
+  return result
+
+
 class Loader:
 
   # control params
@@ -69,6 +384,26 @@ class Loader:
   schema_db_name = None
   schema_collection_name = None
   use_mr = False
+  num_extract_workers = 1
+  compression = None
+  incremental = False
+  schema_gen_mode = 'mapper'
+  schema_shape_cache_size = 0
+  schema_sample = 0
+  schema_gen_workers = multiprocessing.cpu_count()
+  transform_workers = 1
+  hash_function = 'sha1'
+  shard_key = None
+  output_format = 'json'
+  schema_sample_ranges = 1
+  part_size_bytes = PART_SIZE_BYTES
+  part_max_records = None
+  stream_to_cs = False
+  unindexed_sort = 'sort'
+  read_preference = 'primary'
+  follow_changes = False
+  follow_batch_size = FOLLOW_BATCH_SIZE
+  follow_batch_seconds = FOLLOW_BATCH_SECONDS
 
   hiveserveer_host = None
   hiveserver_port = None
@@ -89,6 +424,7 @@ class Loader:
 
   # runtime variables
   extract_file_names = []
+  extract_part_sizes = []
   reject_file_names = []
   sort_by_field_min = None
   sort_by_field_max = None
@@ -97,9 +433,17 @@ class Loader:
   cs = None
   num_records_extracted = 0
   num_records_rejected = 0
+  checkpoint_value = None
+  follow_resume_token = None
+  follow_oplog_ts = None
+  inline_schema_fields = {}
+  extract_query_json = None
 
   # policy related variables
   required_fields = {}
+  included_fields = []
+  excluded_fields = []
+  projection = None
 
 
   def initialize(self):
@@ -117,10 +461,12 @@ class Loader:
 
     # create data warehouse object
     if self.infra_type == 'hadoop':
-      self.dw = Hive(self.hiveserveer_host, self.hiveserver_port, ONEFOLD_HIVESERDES_JAR)
+      self.dw = Hive(self.hiveserveer_host, self.hiveserver_port, ONEFOLD_HIVESERDES_JAR, self.output_format)
       self.cs = HDFSStorage()
     elif self.infra_type == 'gcloud':
-      self.dw = GBigQuery(self.gcloud_project_id, self.gcloud_storage_bucket_id)
+      # in incremental mode, loads must finish before the high-water mark is saved
+      self.dw = GBigQuery(self.gcloud_project_id, self.gcloud_storage_bucket_id, self.output_format,
+                          sync_loads = self.incremental)
       self.cs = GCloudStorage(self.gcloud_project_id, self.gcloud_storage_bucket_id)
 
     # turn policies into better data structure for use later (required_fields)
@@ -147,8 +493,115 @@ class Loader:
                         "forced": True}},
               upsert = True)
 
+          if policy.get('include'):
+            self.included_fields.append(policy['key'])
+
+          if policy.get('exclude'):
+            self.excluded_fields.append(policy['key'])
+
+          if policy.get('shard_key') and self.shard_key is None:
+            self.shard_key = policy['key']
+
+    # turn include / exclude policies into a mongo projection
+    self.projection = self.get_projection()
+
+    # excluded fields may already be in the schema collection from earlier (append) runs. Remove
+    # them so schema generation, transform and table creation skip the same paths. Forced data
+    # types from the policy file are kept.
+    for excluded_field in self.excluded_fields:
+      schema_key = self.get_schema_key(excluded_field)
+      schema_record = self.mongo_schema_collection.find_one({"key": schema_key, "type": "field"})
+      if schema_record is None or schema_record.get('forced'):
+        continue
+
+      self.mongo_schema_collection.delete_one({"_id": schema_record['_id']})
+
+      # only records have child fields. Elements of repeated records are joined with "."
+      if schema_record.get('data_type') == 'record':
+        separator = "." if schema_record.get('mode') == 'repeated' else "_"
+        self.mongo_schema_collection.delete_many(
+          {"type": "field",
+           "key": {"$regex": "^%s" % re.escape(schema_key + separator)},
+           "forced": {"$ne": True}})
+
+
+  # schema key of a field in dot notation (e.g. "address.city" -> "address_city"). Fields of
+  # repeated records are joined with "." (e.g. "phones.number"), as in schema generation.
+  def get_schema_key(self, field):
+    schema_key = None
+    for part in field.split("."):
+      if schema_key is None:
+        schema_key = walker_util.clean_key(part)
+        continue
+
+      parent_record = self.mongo_schema_collection.find_one({"key": schema_key, "type": "field"})
+      if parent_record is not None and parent_record.get('mode') == 'repeated':
+        schema_key = "%s.%s" % (schema_key, walker_util.clean_key(part))
+      else:
+        schema_key = "%s_%s" % (schema_key, walker_util.clean_key(part))
+    return schema_key
 
-  def extract_data(self):
+
+  # build mongo projection from include / exclude policies. Mongo doesn't allow mixing the two.
+  def get_projection(self):
+
+    if len(self.included_fields) > 0 and len(self.excluded_fields) > 0:
+      raise ValueError("Policy file can't have both include and exclude fields.")
+
+    if len(self.included_fields) > 0:
+      projection = dict((field, 1) for field in self.included_fields)
+
+      # always fetch sort-by field (for auditing) and required fields (for validation)
+      projection[self.collection_sort_by_field] = 1
+      for required_field_name in self.required_fields:
+        projection[required_field_name] = 1
+
+      return projection
+
+    if len(self.excluded_fields) > 0:
+      for excluded_field in self.excluded_fields:
+        if excluded_field == self.collection_sort_by_field or excluded_field in self.required_fields:
+          raise ValueError("Field %s can't be excluded since it is the sort-by field or a required field." % excluded_field)
+
+      return dict((field, 0) for field in self.excluded_fields)
+
+    return None
+
+
+  # sample the sort-by field and return N-1 quantiles that split the keyspace into N ranges
+  def get_extract_boundaries(self, collection, extract_query_json, num_ranges):
+
+    pipeline = []
+    if extract_query_json is not None:
+      pipeline.append({"$match": extract_query_json})
+    pipeline.append({"$sample": {"size": num_ranges * NUM_BOUNDARY_SAMPLES_PER_RANGE}})
+    pipeline.append({"$project": {"_id": 0, "value": "$%s" % self.collection_sort_by_field}})
+    pipeline.append({"$sort": {"value": 1}})
+
+    samples = [x['value'] for x in collection.aggregate(pipeline, allowDiskUse=True) if x.get('value') is not None]
+    samples = get_boundary_samples(samples)
+
+    boundaries = []
+    for i in range(1, num_ranges):
+      if len(samples) == 0:
+        break
+      boundary = samples[i * len(samples) // num_ranges]
+      if len(boundaries) == 0 or boundaries[-1] != boundary:
+        boundaries.append(boundary)
+
+    return boundaries
+
+
+  # create tmp_path folders and delete files from the last extraction
+  def prepare_tmp_path(self):
+
+    # streaming mode writes straight to cloud storage folders
+    if self.stream_to_cs:
+      for folder in ('data', 'rejected'):
+        cs_folder = "%s/%s/%s" % (CLOUD_STORAGE_PATH, self.collection_name, folder)
+        self.cs.rmdir(cs_folder)
+        self.cs.mkdir(cs_folder)
+      return
 
     # create tmp_path folder if necessary
     if not os.path.exists(os.path.join(self.tmp_path, self.collection_name, 'data')):
@@ -166,105 +619,252 @@ class Loader:
       print "Deleting old file %s" % (old_file)
       os.remove(old_file)
 
-    # some state variables
-    part_num = 0
-    extract_file = None
-
-    reject_part_num = 0
-    reject_file = None
 
-    # start mongo client
-    db = self.mongo_client[self.db_name]
-    collection = db[self.collection_name]
-
-    # turn query string into json
-    if self.extract_query is not None:
-      if 'ObjectId' in self.extract_query:
-        # kinda hacky.. and dangerous! This is to evaluate an expression
-        # like {"_id": {$gt:ObjectId("55401a60151a4b1a4f000001")}}
-        from bson.objectid import ObjectId
-        extract_query_json = eval(self.extract_query)
-      else:
-        extract_query_json = json.loads(self.extract_query)
+  # params shared by all extraction ranges (and follow-mode batches)
+  def get_extract_params(self):
+    params = {}
+    params['mongo_uri'] = self.mongo_uri
+    params['db_name'] = self.db_name
+    params['collection_name'] = self.collection_name
+    params['collection_sort_by_field'] = self.collection_sort_by_field
+    params['tmp_path'] = self.tmp_path
+    params['required_fields'] = self.required_fields
+    params['compression'] = self.compression
+    params['projection'] = self.projection
+    params['schema_gen_mode'] = self.schema_gen_mode
+    params['schema_shape_cache_size'] = self.schema_shape_cache_size
+    params['file_prefix'] = ""
+    params['part_size_bytes'] = self.part_size_bytes
+    params['part_max_records'] = self.part_max_records
+    params['read_preference'] = self.read_preference
+    params['sorted'] = True
+    params['hint'] = None
+    params['allow_disk_use'] = False
+    if self.stream_to_cs:
+      params['cs'] = self.cs
     else:
-      extract_query_json = None
+      params['cs'] = None
+    return params
+
 
-    # query collection, sort by collection_sort_by_field
-    for data in collection.find(extract_query_json).sort(self.collection_sort_by_field, 1):
+  # add up result of write_extract_files. Results must be added in sort-by field order.
+  def add_extract_result(self, result):
+    self.extract_file_names.extend(result['extract_file_names'])
+    self.extract_part_sizes.extend(result['extract_part_sizes'])
+    self.reject_file_names.extend(result['reject_file_names'])
+    self.num_records_extracted += result['num_records_extracted']
+    self.num_records_rejected += result['num_records_rejected']
+    schema_util.merge_fields(self.inline_schema_fields, result['schema_fields'].iteritems())
 
-      # track min and max id for auditing..
+    if result['sort_by_field_min'] is not None:
       if self.sort_by_field_min == None:
-        self.sort_by_field_min = data[self.collection_sort_by_field]
-      self.sort_by_field_max = data[self.collection_sort_by_field]
+        self.sort_by_field_min = result['sort_by_field_min']
+      self.sort_by_field_max = result['sort_by_field_max']
+
+
+  # turn query string into json
+  def parse_extract_query(self):
+    if self.extract_query is None:
+      return None
 
-      # open a new file if necessary
-      if self.num_records_extracted % NUM_RECORDS_PER_PART == 0:
+    if 'ObjectId' in self.extract_query:
+      # kinda hacky.. and dangerous! This is to evaluate an expression
+      # like {"_id": {$gt:ObjectId("55401a60151a4b1a4f000001")}}
+      from bson.objectid import ObjectId
+      return eval(self.extract_query)
+    else:
+      return json.loads(self.extract_query)
+
+
+  # inspect indexes and decide how to read the collection in sort-by field order: use an index
+  # with the sort-by field as leading key, or handle an unindexed sort based on unindexed_sort.
+  def plan_extract_query(self, collection):
 
-        if extract_file != None:
-          extract_file.close()
+    plan = {'sorted': True, 'hint': None, 'allow_disk_use': False}
 
-        part_num += 1
-        extract_file_name = os.path.join(self.tmp_path, self.collection_name, 'data', str(part_num))
-        extract_file = open(extract_file_name, "w")
-        extract_file_codec = codecs.getwriter("utf-8")(extract_file)
-        self.extract_file_names.append(extract_file_name)
-        print "Creating file %s" % extract_file_name
+    for index_name, index_info in sorted(collection.index_information().iteritems()):
+      if index_info['key'][0][0] == self.collection_sort_by_field:
+        if is_sort_index(index_info):
+          print "Using index %s for sort-by field %s" % (index_name, self.collection_sort_by_field)
+          plan['hint'] = index_name
+          return plan
+        print "Index %s can't serve the sort on %s over all documents. Skipping it." % (index_name, self.collection_sort_by_field)
 
-      # validate policies
-      rejected = False
-      for required_field_name, policy in self.required_fields.iteritems():
-        if policy['required'] and jsonpath_get(data, required_field_name) is None:
+    print "No usable index found with leading key %s. Unindexed sort: %s" % (self.collection_sort_by_field, self.unindexed_sort)
 
-          # --------------------------------------------------------
-          # document found that doesn't contain required fields.
-          # --------------------------------------------------------
+    if self.unindexed_sort == 'fail':
+      raise ValueError("Sort-by field %s of %s.%s is not indexed. Create an index on it, pick an indexed "
+                       "source_sort_by_field, or set unindexed_sort to natural or disk."
+                       % (self.collection_sort_by_field, self.db_name, self.collection_name))
+    elif self.unindexed_sort == 'natural':
+      plan['sorted'] = False
+    elif self.unindexed_sort == 'disk':
+      plan['allow_disk_use'] = True
 
-          # open a new file if necessary
-          if self.num_records_rejected % NUM_RECORDS_PER_PART == 0:
+    return plan
 
-            if reject_file != None:
-              reject_file.close()
 
-            reject_part_num += 1
-            reject_file_name = os.path.join(self.tmp_path, self.collection_name, 'rejected', str(reject_part_num))
-            reject_file = open(reject_file_name, "w")
-            reject_file_codec = codecs.getwriter("utf-8")(reject_file)
-            self.reject_file_names.append(reject_file_name)
-            print "Creating reject file %s" % reject_file_name
+  def extract_data(self):
 
-          self.num_records_rejected += 1
-          reject_file_codec.write("Rejected. Missing %s. Data: %s" % (required_field_name, dumps(data)))
-          reject_file_codec.write('\n')
+    self.prepare_tmp_path()
 
-          rejected = True
-          break
+    # start mongo client
+    collection = get_source_collection(self.mongo_client, self.db_name, self.collection_name, self.read_preference)
+    plan = self.plan_extract_query(collection)
+
+    extract_query_json = self.parse_extract_query()
+
+    # in incremental mode, resume from the high-water mark saved by the last successful run
+    if self.incremental:
+      self.checkpoint_value = self.get_checkpoint()
+      if self.checkpoint_value is not None:
+        print "Resuming extraction from %s > %s" % (self.collection_sort_by_field, self.checkpoint_value)
+        checkpoint_query = {self.collection_sort_by_field: {"$gt": self.checkpoint_value}}
+        if extract_query_json is not None:
+          extract_query_json = {"$and": [extract_query_json, checkpoint_query]}
+        else:
+          extract_query_json = checkpoint_query
 
-      if not rejected:
-        self.num_records_extracted += 1
-        extract_file_codec.write(dumps(data))
-        extract_file_codec.write('\n')
+    self.extract_query_json = extract_query_json
 
-    if extract_file != None:
+    # split sort-by field keyspace into ranges. one range = serial extraction.
+    if self.num_extract_workers > 1:
+      boundaries = self.get_extract_boundaries(collection, extract_query_json, self.num_extract_workers)
+      print "Extracting %s ranges with boundaries %s" % (len(boundaries) + 1, boundaries)
+    else:
+      boundaries = []
+
+    range_bounds = zip([None] + boundaries, boundaries + [None])
+
+    extract_params = []
+    for range_num, (lower_bound, upper_bound) in enumerate(range_bounds):
+      params = self.get_extract_params()
+      params['extract_query_json'] = extract_query_json
+      params['lower_bound'] = lower_bound
+      params['upper_bound'] = upper_bound
+      params.update(plan)
+      if len(range_bounds) > 1:
+        params['file_prefix'] = "%s_" % (range_num + 1)
+      extract_params.append(params)
+
+    if len(extract_params) > 1:
+      pool = multiprocessing.Pool(processes=self.num_extract_workers)
+      try:
+        results = pool.map(extract_partition, extract_params)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [extract_partition(extract_params[0])]
+
+    # results come back in range order, so min is the first range's min and max is the last range's max.
+    for result in results:
+      self.add_extract_result(result)
+
+  # generate lines of all extracted files
+  def read_extract_files(self):
+    for extract_file_name in self.extract_file_names:
+      print "Reading file %s" % extract_file_name
+      extract_file = open_compressed_input(extract_file_name, self.compression)
+      for line in extract_file:
+        yield line
       extract_file.close()
 
-    if reject_file != None:
-      reject_file.close()
 
+  # run schema mapper / reducer logic in-process
   def simple_schema_gen(self):
-    command = "cat %s | json/generate-schema-mapper.py | sort | json/generate-schema-reducer.py %s/%s/%s > /dev/null" \
-              % (' '.join(self.extract_file_names), self.mongo_uri, self.schema_db_name, self.schema_collection_name)
-    execute(command)
+    shape_cache = None
+    if self.schema_shape_cache_size > 0:
+      shape_cache = schema_util.ShapeCache(self.schema_shape_cache_size)
 
+    fields = schema_util.merge_fields({}, schema_util.generate_schema(self.read_extract_files(), shape_cache))
+    if shape_cache is not None:
+      print "Schema inferred from %s distinct document shapes, skipped %s documents." % (shape_cache.num_misses, shape_cache.num_hits)
+    schema_util.save_schema(self.mongo_schema_collection, fields)
 
-  def mr_schema_gen(self):
+
+  # infer schema of each extracted part file in a process pool and merge the results
+  def parallel_schema_gen(self):
+
+    part_params = []
+    for extract_file_name in self.extract_file_names:
+      params = {}
+      params['file_name'] = extract_file_name
+      params['compression'] = self.compression
+      params['schema_shape_cache_size'] = self.schema_shape_cache_size
+      part_params.append(params)
+
+    pool = multiprocessing.Pool(processes=self.schema_gen_workers)
+    try:
+      part_fields = pool.map(generate_part_schema, part_params)
+    finally:
+      pool.close()
+      pool.join()
+
+    fields = schema_util.merge_schemas(part_fields)
+    print "Merged %s fields from %s part files." % (len(fields), len(part_fields))
+    schema_util.save_schema(self.mongo_schema_collection, fields)
+
+
+  # save schema inferred during extraction to schema collection
+  def inline_schema_gen(self):
+    print "Saving %s fields inferred during extraction." % len(self.inline_schema_fields)
+    schema_util.save_schema(self.mongo_schema_collection, self.inline_schema_fields)
+
+
+  # infer schema from a server-side $sample of the documents being extracted, optionally
+  # stratified by ranges of the sort-by field, instead of scanning all extracted files
+  def sample_schema_gen(self):
+
+    collection = get_source_collection(self.mongo_client, self.db_name, self.collection_name, self.read_preference)
+
+    if self.schema_sample_ranges > 1:
+      boundaries = self.get_extract_boundaries(collection, self.extract_query_json, self.schema_sample_ranges)
+    else:
+      boundaries = []
+
+    range_bounds = zip([None] + boundaries, boundaries + [None])
+    sample_size = max(1, self.schema_sample // len(range_bounds))
+
+    shape_cache = None
+    if self.schema_shape_cache_size > 0:
+      shape_cache = schema_util.ShapeCache(self.schema_shape_cache_size)
+
+    fields = {}
+    num_sampled = 0
+    for lower_bound, upper_bound in range_bounds:
+
+      pipeline = []
+      query = get_range_query(self.extract_query_json, self.collection_sort_by_field, lower_bound, upper_bound)
+      if query is not None:
+        pipeline.append({"$match": query})
+      pipeline.append({"$sample": {"size": sample_size}})
+      if self.projection is not None:
+        pipeline.append({"$project": self.projection})
+
+      for data in collection.aggregate(pipeline, allowDiskUse=True):
+        num_sampled += 1
+        encode_util.json_convert(data)
+        if shape_cache is None or not shape_cache.seen(data):
+          try:
+            schema_util.merge_fields(fields, schema_util.infer_schema(data))
+          except Exception:
+            print "Error inferring schema. Data: %s" % encode_util.dumps(data)
+
+    print "Inferred %s fields from %s sampled documents in %s ranges." % (len(fields), num_sampled, len(range_bounds))
+    schema_util.save_schema(self.mongo_schema_collection, fields)
+
+
+  def copy_extract_files_to_cs(self):
+
+    # already there if extraction streamed to cloud storage
+    if self.stream_to_cs:
+      return
 
     hdfs_data_folder = "%s/%s/data" % (CLOUD_STORAGE_PATH, self.collection_name)
-    hdfs_mr_output_folder = "%s/%s/schema_gen/output" % (CLOUD_STORAGE_PATH, self.collection_name)
 
     # delete folders
     self.cs.rmdir(hdfs_data_folder)
-    self.cs.rmdir(hdfs_mr_output_folder)
-    
 
     # copy extracted files to hdfs data folder
     self.cs.mkdir(hdfs_data_folder)
@@ -272,16 +872,28 @@ class Loader:
     for extract_file_name in self.extract_file_names:
       self.cs.copy_from_local(extract_file_name, hdfs_data_folder)
 
+
+  def mr_schema_gen(self):
+
+    hdfs_data_folder = "%s/%s/data" % (CLOUD_STORAGE_PATH, self.collection_name)
+    hdfs_mr_output_folder = "%s/%s/schema_gen/output" % (CLOUD_STORAGE_PATH, self.collection_name)
+
+    # delete folders
+    self.cs.rmdir(hdfs_mr_output_folder)
+
     hadoop_command = """hadoop jar %s \
                               -D mapred.job.name="onefold-mongo-generate-schema" \
                               %s \
                               -input %s -output %s \
-                              -mapper 'json/generate-schema-mapper.py' \
+                              -mapper 'json/generate-schema-mapper.py %s' \
                               -reducer 'json/generate-schema-reducer.py %s/%s/%s' \
                               -file json/generate-schema-mapper.py \
-                              -file json/generate-schema-reducer.py
+                              -file json/generate-schema-reducer.py \
+                              -file json/schema_util.py \
+                              -file json/codec_util.py \
+                              -file json/walker_util.py
     """ % (HADOOP_MAPREDUCE_STREAMING_LIB, MAPREDUCE_PARAMS_STR, hdfs_data_folder,
-           hdfs_mr_output_folder, self.mongo_uri,
+           hdfs_mr_output_folder, self.schema_shape_cache_size, self.mongo_uri,
            self.schema_db_name, self.schema_collection_name)
     execute(hadoop_command)
 
@@ -291,10 +903,59 @@ class Loader:
     hdfs_mr_output_folder = "%s/%s/data_transform/output" % (CLOUD_STORAGE_PATH, self.collection_name)
     transform_data_tmp_path = "%s/%s/data_transform/output" % (self.tmp_path, self.collection_name)
 
-    command = "cat %s | json/transform-data-mapper.py %s/%s/%s,%s > /dev/null" \
-              % (' '.join(self.extract_file_names), self.mongo_uri, self.schema_db_name,
-                 self.schema_collection_name, transform_data_tmp_path)
-    execute(command)
+    # delete temp folder if already exist
+    execute('rm -rf %s' % transform_data_tmp_path, ignore_error=True)
+
+    # fragments (and shards) of the last run were loaded already
+    self.mongo_schema_collection.delete_many({"type": "fragments"})
+
+    schema = transform_util.load_schema(self.mongo_schema_collection)
+
+    if self.transform_workers > 1:
+      # transform part files in a process pool, each into its own part-NNNNN per fragment
+      part_params = []
+      for part_num, extract_file_name in enumerate(self.extract_file_names):
+        params = {}
+        params['file_name'] = extract_file_name
+        params['compression'] = self.compression
+        params['schema'] = schema
+        params['process_array'] = self.process_array
+        params['hash_function'] = self.hash_function
+        params['shard_key'] = self.shard_key
+        params['output_format'] = self.output_format
+        params['tmp_path'] = transform_data_tmp_path
+        params['part_name'] = "part-%05d" % part_num
+        part_params.append(params)
+
+      pool = multiprocessing.Pool(processes=self.transform_workers)
+      try:
+        results = pool.map(transform_part, part_params)
+      finally:
+        pool.close()
+        pool.join()
+
+      fragment_values = set()
+      shard_values = []
+      for result in results:
+        fragment_values.update(result['fragment_values'])
+        shard_values.extend(result['shard_values'])
+      missing_fields = schema_util.merge_schemas([result['missing_fields'] for result in results])
+
+    else:
+      # run transform mapper logic in-process
+      transformer = transform_util.DataTransformer(schema, self.process_array, self.shard_key, self.hash_function)
+      writer = transform_util.create_fragment_writer(transform_data_tmp_path, schema, self.output_format, self.compression)
+      for fragment_value, row in transformer.transform(self.read_extract_files()):
+        writer.write(fragment_value, row)
+
+      fragment_values = writer.close()
+      shard_values = transformer.shard_values
+      missing_fields = transformer.missing_fields
+
+    transform_util.save_fragments(self.mongo_schema_collection, fragment_values, self.shard_key, shard_values)
+
+    # keys missing from the schema are saved, so they are loaded on the next run
+    transform_util.save_missing_fields(self.mongo_schema_collection, missing_fields)
 
     # delete folders
     self.cs.rmdir (hdfs_mr_output_folder)
@@ -303,9 +964,9 @@ class Loader:
     fragment_values = self.get_fragments()
     for fragment_value in fragment_values:
       self.cs.mkdir("%s/%s" % (hdfs_mr_output_folder, fragment_value))
-      self.cs.copy_from_local("%s/%s/part-00000" % (transform_data_tmp_path, fragment_value),
-                              "%s/%s/" % (hdfs_mr_output_folder, fragment_value))
-      
+      for part_file_name in sorted(glob.glob("%s/%s/part-*" % (transform_data_tmp_path, fragment_value))):
+        self.cs.copy_from_local(part_file_name, "%s/%s/" % (hdfs_mr_output_folder, fragment_value))
+
 
   def mr_data_transform(self):
 
@@ -315,17 +976,33 @@ class Loader:
     # delete folders
     self.cs.rmdir(hdfs_mr_output_folder)
 
+    # fragments (and shards) of the last run were loaded already
+    self.mongo_schema_collection.delete_many({"type": "fragments"})
+
+    # compress each fragment output file (extracted input files are decompressed by hadoop based on extension)
+    if self.compression is not None:
+      compression_params_str = "-D mapred.output.compress=true -D mapred.output.compression.codec=%s" \
+                               % HADOOP_COMPRESSION_CODECS[self.compression]
+    else:
+      compression_params_str = ""
+
     hadoop_command = """hadoop jar %s \
                               -libjars %s \
                               -D mapred.job.name="onefold-mongo-transform-data" \
                               -D mapred.reduce.tasks=0 \
-                              %s \
+                              %s %s \
                               -input %s -output %s \
-                              -mapper 'json/transform-data-mapper.py %s/%s/%s' \
+                              -mapper 'json/transform-data-mapper.py %s/%s/%s,,,%s,%s,%s' \
                               -file json/transform-data-mapper.py \
+                              -file json/transform_util.py \
+                              -file json/codec_util.py \
+                              -file json/schema_util.py \
+                              -file json/walker_util.py \
                               -outputformat com.onefold.hadoop.MapReduce.TransformDataMultiOutputFormat
-    """ % (HADOOP_MAPREDUCE_STREAMING_LIB, ONEFOLD_MAPREDUCE_JAR, MAPREDUCE_PARAMS_STR, hdfs_data_folder, hdfs_mr_output_folder, self.mongo_uri,
-           self.schema_db_name, self.schema_collection_name)
+    """ % (HADOOP_MAPREDUCE_STREAMING_LIB, ONEFOLD_MAPREDUCE_JAR, MAPREDUCE_PARAMS_STR, compression_params_str,
+           hdfs_data_folder, hdfs_mr_output_folder, self.mongo_uri,
+           self.schema_db_name, self.schema_collection_name, self.hash_function, self.shard_key or '',
+           self.process_array)
     execute(hadoop_command)
 
 
@@ -349,6 +1026,25 @@ class Loader:
     return schema_fields
 
 
+  # retrieve high-water mark of sort-by field saved by the last incremental run
+  def get_checkpoint(self):
+    checkpoint_record = self.mongo_schema_collection.find_one({"type": "checkpoint",
+                                                               "sort_by_field": self.collection_sort_by_field})
+    if checkpoint_record != None:
+      return checkpoint_record['sort_by_field_max']
+    else:
+      return None
+
+
+  # save high-water mark of sort-by field so the next incremental run only reads newer documents
+  def save_checkpoint(self):
+    print "Saving checkpoint %s = %s" % (self.collection_sort_by_field, self.sort_by_field_max)
+    self.mongo_schema_collection.update_one({"type": "checkpoint"},
+                                            {"$set": {"sort_by_field": self.collection_sort_by_field,
+                                                      "sort_by_field_max": self.sort_by_field_max}},
+                                            upsert = True)
+
+
   def get_fragments(self):
     fragment_record = self.mongo_schema_collection.find_one({"type": "fragments"})
     if fragment_record != None:
@@ -357,7 +1053,7 @@ class Loader:
       return []
 
 
-  def load_table_hive (self, shard_value = None, table_name = None, different_table_per_shard = False, data_import_id = None):
+  def load_table_hive (self, shard_value = None, table_name = None, different_table_per_shard = False, data_import_id = None, partition = None):
 
     # if shard_value is None:
     #   gcs_uri = "%s/data/*" % (self.mr4_output_folder_uri)
@@ -370,7 +1066,7 @@ class Loader:
       full_table_name = "%s" % (table_name)
 
     cloud_storage_path = "%s/%s/data_transform/output/%s/" % (CLOUD_STORAGE_PATH, self.collection_name, shard_value)
-    self.dw.load_table(self.dw_database_name, full_table_name, cloud_storage_path)
+    self.dw.load_table(self.dw_database_name, full_table_name, cloud_storage_path, partition)
 
     # extract bq_job_id and save to db
     return "%s/%s" % (data_import_id, shard_value)
@@ -381,21 +1077,27 @@ class Loader:
     # retrieve schema fields from mongodb schema collection
     schema_fields = self.retrieve_schema_fields()
 
+    # check all shard values before creating tables, so a bad one doesn't leave a partially loaded table
+    fragment_values = self.get_fragments()
+    for fragment_value in fragment_values or []:
+      if "/" in fragment_value:
+        self.dw.check_partition(fragment_value.split("/", 1)[1])
+
     # create tables
     if self.write_disposition == 'overwrite':
       if self.dw.table_exists(self.dw_database_name, self.dw_table_name):
         self.dw.delete_table(self.dw_database_name, self.dw_table_name)
-      self.dw_table_names = self.dw.create_table(self.dw_database_name, self.dw_table_name, schema_fields, self.process_array)
+      self.dw_table_names = self.dw.create_table(self.dw_database_name, self.dw_table_name, schema_fields, self.process_array,
+                                                 self.shard_key is not None)
     else:
       # if append, update table.
       if self.dw.table_exists(self.dw_database_name, self.dw_table_name):
         self.dw_table_names = self.dw.update_table(self.dw_database_name, self.dw_table_name, schema_fields)
       else:
-        self.dw_table_names = self.dw.create_table(self.dw_database_name, self.dw_table_name, schema_fields, self.process_array)
+        self.dw_table_names = self.dw.create_table(self.dw_database_name, self.dw_table_name, schema_fields, self.process_array,
+                                                   self.shard_key is not None)
 
     # load data
-    fragment_values = self.get_fragments()
-
     if fragment_values == None or len(fragment_values) == 0:
       table_name = self.dw_table_name
       self.load_table_hive(shard_value = None, table_name = table_name, different_table_per_shard=False, data_import_id=None)
@@ -403,40 +1105,238 @@ class Loader:
     else:
       for fragment_value in fragment_values:
         print "Loading fragment: " + fragment_value
-        if fragment_value == 'root':
+
+        # root rows are split into root/[shard value] fragments, each loaded into its own partition
+        table_fragment_value = fragment_value
+        partition = None
+        if "/" in fragment_value:
+          (table_fragment_value, partition) = fragment_value.split("/", 1)
+
+        if table_fragment_value == 'root':
           table_name = self.dw_table_name
         else:
-          table_name = self.dw_table_name + "_" + fragment_value
+          table_name = self.dw_table_name + "_" + table_fragment_value
+
+        self.load_table_hive(shard_value = fragment_value, table_name = table_name, different_table_per_shard=False,
+                             data_import_id=None, partition=partition)
+
+
+  # generate schema, transform extracted data and load it into data warehouse
+  def transform_and_load(self):
+
+    # generate schema and transform data
+    if self.use_mr:
+      self.copy_extract_files_to_cs()
+      if self.schema_sample > 0:
+        self.sample_schema_gen()
+      elif self.schema_gen_mode == 'inline':
+        self.inline_schema_gen()
+      else:
+        self.mr_schema_gen()
+      self.mr_data_transform()
+    else:
+      if self.schema_sample > 0:
+        self.sample_schema_gen()
+      elif self.schema_gen_mode == 'inline':
+        self.inline_schema_gen()
+      elif self.schema_gen_mode == 'parallel':
+        self.parallel_schema_gen()
+      else:
+        self.simple_schema_gen()
+      self.simple_data_transform()
+
+    # Create data warehouse tables and load data into them
+    self.load_dw()
+
+
+  # reset runtime variables before extracting a new batch
+  def reset_extract_state(self):
+    self.extract_file_names = []
+    self.extract_part_sizes = []
+    self.reject_file_names = []
+    self.num_records_extracted = 0
+    self.num_records_rejected = 0
+    self.sort_by_field_min = None
+    self.sort_by_field_max = None
+    self.inline_schema_fields = {}
+
+
+  # retrieve change stream resume token or oplog timestamp saved after the last loaded batch
+  def get_follow_checkpoint(self):
+    checkpoint_record = self.mongo_schema_collection.find_one({"type": "follow_checkpoint"})
+    if checkpoint_record != None:
+      return (checkpoint_record.get('resume_token'), checkpoint_record.get('oplog_ts'))
+    else:
+      return (None, None)
+
+
+  def save_follow_checkpoint(self):
+    self.mongo_schema_collection.update_one({"type": "follow_checkpoint"},
+                                            {"$set": {"resume_token": self.follow_resume_token,
+                                                      "oplog_ts": self.follow_oplog_ts}},
+                                            upsert = True)
+
+
+  # generate inserted / updated documents from a change stream, or by tailing the oplog for
+  # servers without change streams. Yields None when there is no change for a while.
+  def watch_changes(self, collection):
+
+    (self.follow_resume_token, self.follow_oplog_ts) = self.get_follow_checkpoint()
+
+    # match the extract query on fullDocument, then project it so excluded fields never leave the server
+    query_json = self.parse_extract_query()
+    change_match = {"operationType": {"$in": ["insert", "update", "replace"]}}
+    if query_json is not None:
+      change_match.update(get_change_stream_query(query_json))
+    pipeline = [{"$match": change_match}]
+    if self.projection is not None:
+      projection = dict(("fullDocument.%s" % field, v) for field, v in self.projection.iteritems())
+      if self.projection.values()[0] == 1:
+        projection['operationType'] = 1
+      pipeline.append({"$project": projection})
+
+    try:
+      stream = collection.watch(pipeline, full_document='updateLookup', resume_after=self.follow_resume_token,
+                                max_await_time_ms=FOLLOW_MAX_AWAIT_TIME_MS)
+    except AttributeError as e:
+      # pymongo before 3.6
+      print "Change streams not supported by pymongo (%s). Tailing oplog instead." % e
+      stream = None
+    except OperationFailure as e:
+      # anything else (e.g. history lost, invalid resume token, auth) would silently skip changes
+      if e.code not in CHANGE_STREAM_UNSUPPORTED_CODES:
+        raise
+      print "Change streams not supported (%s). Tailing oplog instead." % e
+      stream = None
+
+    # the oplog can't resume from a change stream token, and starting from its end would skip changes
+    if stream is None and self.follow_resume_token is not None and self.follow_oplog_ts is None:
+      raise ValueError("Can't resume from the saved change stream checkpoint without change streams. "
+                       "Delete the follow_checkpoint record to start following from now.")
+
+    if stream is not None:
+      print "Watching change stream of %s.%s" % (self.db_name, self.collection_name)
+      while stream.alive:
+        change = stream.try_next()
+        if change is None:
+          yield None
+        else:
+          self.follow_resume_token = change['_id']
+          if change.get('fullDocument') is not None:
+            yield change['fullDocument']
+      return
+
+    oplog = get_source_collection(self.mongo_client, 'local', 'oplog.rs', self.read_preference)
+    if self.follow_oplog_ts is None:
+      self.follow_oplog_ts = oplog.find().sort('$natural', -1).limit(1).next()['ts']
+
+    print "Tailing oplog of %s.%s from %s" % (self.db_name, self.collection_name, self.follow_oplog_ts)
+    while True:
+      query = {"ts": {"$gt": self.follow_oplog_ts},
+               "ns": "%s.%s" % (self.db_name, self.collection_name),
+               "op": {"$in": ["i", "u"]}}
+      cursor = oplog.find(query, cursor_type=CursorType.TAILABLE_AWAIT, oplog_replay=True)
+
+      while cursor.alive:
+        try:
+          entry = cursor.next()
+        except StopIteration:
+          yield None
+          continue
+
+        self.follow_oplog_ts = entry['ts']
+        if entry['op'] == 'i' and query_json is None and self.projection is None:
+          yield entry['o']
+        else:
+          # update entries only contain the modification, and inserts must be matched against the
+          # query and projected, so look up the full document
+          document_id = entry['o']['_id'] if entry['op'] == 'i' else entry['o2']['_id']
+          document_query = {"_id": document_id}
+          if query_json is not None:
+            document_query = {"$and": [document_query, query_json]}
+          document = collection.find_one(document_query, self.projection)
+          if document is not None:
+            yield document
+
+      time.sleep(1)
 
-        self.load_table_hive(shard_value = fragment_value, table_name = table_name, different_table_per_shard=False, data_import_id=None)
+
+  # long running mode: micro-batch changed documents and load each batch when it reaches
+  # follow_batch_size documents or follow_batch_seconds seconds.
+  def follow(self):
+
+    collection = get_source_collection(self.mongo_client, self.db_name, self.collection_name, self.read_preference)
+    params = self.get_extract_params()
+    params['sorted'] = False
+
+    batch = []
+    batch_start_time = time.time()
+
+    for document in self.watch_changes(collection):
+
+      if document is not None:
+        batch.append(document)
+
+      if len(batch) == 0:
+        batch_start_time = time.time()
+        continue
+
+      if len(batch) < self.follow_batch_size and time.time() - batch_start_time < self.follow_batch_seconds:
+        continue
+
+      print "Loading batch of %s documents." % len(batch)
+      self.reset_extract_state()
+      self.prepare_tmp_path()
+      self.add_extract_result(write_extract_files(batch, params))
+
+      if self.num_records_extracted > 0:
+        self.transform_and_load()
+
+      self.save_follow_checkpoint()
+      self.print_summary()
+
+      batch = []
+      batch_start_time = time.time()
 
 
   def run(self):
     # init (start mongo client)
     self.initialize()
 
-    # extract data from Mongo
-    self.extract_data()
+    try:
+      if self.follow_changes:
+        self.follow()
+        return
 
-    if self.num_records_extracted > 0:
-      # generate schema and transform data
-      if self.use_mr:
-        self.mr_schema_gen()
-        self.mr_data_transform()
-      else:
-        self.simple_schema_gen()
-        self.simple_data_transform()
+      # extract data from Mongo
+      self.extract_data()
+
+      if self.num_records_extracted > 0:
+        self.transform_and_load()
 
-      # Create data warehouse tables and load data into them
-      self.load_dw()
+        if self.incremental:
+          self.save_checkpoint()
 
+      self.print_summary()
+    finally:
+      # close data warehouse sessions
+      if self.dw is not None:
+        self.dw.close()
+
+
+  def print_summary(self):
     print '-------------------'
     print '    RUN SUMMARY'
     print '-------------------'
     print 'Num records extracted %s' % self.num_records_extracted
     print 'Num records rejected %s' % self.num_records_rejected
+    if self.incremental:
+      print 'Resumed from checkpoint %s > %s' % (self.collection_sort_by_field, self.checkpoint_value)
     print 'Extracted data with %s from %s to %s' % (self.collection_sort_by_field, self.sort_by_field_min, self.sort_by_field_max)
     print 'Extracted files are located at: %s' % (' '.join(self.extract_file_names))
+    if len(self.extract_part_sizes) > 0:
+      print 'Part size target %s bytes, max records %s. Part sizes from %s to %s bytes' % \
+            (self.part_size_bytes, self.part_max_records, min(self.extract_part_sizes), max(self.extract_part_sizes))
     print 'Destination Tables: %s' % (' '.join(self.dw_table_names))
     print 'Schema is stored in Mongo %s.%s' % (self.schema_db_name, self.schema_collection_name)
 
@@ -469,6 +1369,50 @@ def main():
   parser.add_argument('--dest_table_name', metavar='dest_table_name', type=str,
                       help='Hive table name. If not provided, default to source collection name.')
   parser.add_argument('--use_mr', action='store_true')
+  parser.add_argument('--num_extract_workers', metavar='num_extract_workers', type=int, default=1,
+                      help='Number of processes used to extract data. Each process extracts one range of the sort-by field. Default is 1.')
+  parser.add_argument('--compression', metavar='compression', type=str, choices=['gzip', 'zstd'],
+                      help='Compress extracted and transformed files. One of gzip or zstd. Default is no compression.')
+  parser.add_argument('--incremental', action='store_true',
+                      help='Only extract documents after the high-water mark of the sort-by field saved by the last run. Requires append.')
+  parser.add_argument('--schema_gen_mode', metavar='schema_gen_mode', type=str, default='mapper', choices=['mapper', 'inline', 'parallel'],
+                      help='mapper, inline or parallel. inline infers schema during extraction instead of a separate pass. parallel infers schema of each part file in a process pool (local mode only). Default is mapper.')
+  parser.add_argument('--schema_gen_workers', metavar='schema_gen_workers', type=int, default=multiprocessing.cpu_count(),
+                      help='Number of processes used by parallel schema generation. Default is the number of CPUs.')
+  parser.add_argument('--transform_workers', metavar='transform_workers', type=int, default=1,
+                      help='Number of processes used to transform extracted part files (local mode only). Default is 1.')
+  parser.add_argument('--hash_function', metavar='hash_function', type=str, default='sha1', choices=['sha1', 'blake2b', 'xxhash'],
+                      help='Hash function of row hash_code / parent_hash_code. One of sha1, blake2b or xxhash. Default is sha1.')
+  parser.add_argument('--shard_key', metavar='shard_key', type=str,
+                      help='Field (dot notation) whose value partitions the destination table. Dates are partitioned by day. Can also be set in the policy file.')
+  parser.add_argument('--process_array', metavar='process_array', type=str, default='child_table', choices=['child_table', 'inline', 'nested'],
+                      help='How arrays are loaded: child_table (one table per array), inline (json string column) or nested (RECORD / REPEATED columns, BigQuery only). Default is child_table.')
+  parser.add_argument('--output_format', metavar='output_format', type=str, default='json', choices=['json', 'avro', 'parquet'],
+                      help='Format of transformed files: json, avro (requires fastavro) or parquet (requires pyarrow). avro and parquet are local mode only. Default is json.')
+  parser.add_argument('--schema_shape_cache_size', metavar='schema_shape_cache_size', type=int, default=0,
+                      help='Skip schema inference for documents whose shape (keys and value types) was already seen. Number of shapes to remember. Default is 0 (disabled).')
+  parser.add_argument('--schema_sample', metavar='schema_sample', type=int, default=0,
+                      help='Infer schema from a $sample of this many documents instead of all extracted documents. Default is 0 (disabled).')
+  parser.add_argument('--schema_sample_ranges', metavar='schema_sample_ranges', type=int, default=1,
+                      help='Split the schema sample evenly across this many ranges of the sort-by field. Default is 1.')
+  parser.add_argument('--follow', action='store_true',
+                      help='Keep running, and load inserted / updated documents in batches using change streams (or the oplog). Requires append.')
+  parser.add_argument('--follow_batch_size', metavar='follow_batch_size', type=int, default=FOLLOW_BATCH_SIZE,
+                      help='In follow mode, load a batch once it has this many documents. Default is %s.' % FOLLOW_BATCH_SIZE)
+  parser.add_argument('--follow_batch_seconds', metavar='follow_batch_seconds', type=int, default=FOLLOW_BATCH_SECONDS,
+                      help='In follow mode, load a batch once it is this many seconds old. Default is %s.' % FOLLOW_BATCH_SECONDS)
+  parser.add_argument('--part_size_bytes', metavar='part_size_bytes', type=int, default=PART_SIZE_BYTES,
+                      help='Start a new extracted / rejected part file once it reaches this many (uncompressed) bytes. Default is %s.' % PART_SIZE_BYTES)
+  parser.add_argument('--part_max_records', metavar='part_max_records', type=int,
+                      help='Optional. Also start a new part file once it has this many records.')
+  parser.add_argument('--stream_to_cs', action='store_true',
+                      help='Upload extracted part files to cloud storage while extracting instead of writing them to tmp_path. Requires use_mr.')
+  parser.add_argument('--unindexed_sort', metavar='unindexed_sort', type=str, default='sort',
+                      choices=['sort', 'disk', 'natural', 'fail'],
+                      help='What to do if source_sort_by_field is not indexed: sort (in memory), disk (sort with allowDiskUse), natural (natural order) or fail. Default is sort.')
+  parser.add_argument('--read_preference', metavar='read_preference', type=str, default='primary',
+                      choices=sorted(READ_PREFERENCES.keys()),
+                      help='Read preference used to extract data, e.g. secondary. Default is primary.')
   parser.add_argument('--policy_file', metavar='policy_file', type=str,
                       help='Data Policy file name.')
   parser.add_argument('--infra_type', metavar='infra_type', type=str, default='hadoop',
@@ -518,11 +1462,30 @@ def main():
     if args.gcloud_storage_bucket_id is None:
       raise ValueError("gcloud_storage_bucket_id must be specified for 'gcloud' infrastructure type.")
 
+    if args.compression == 'zstd':
+      raise ValueError("zstd compression is not supported by BigQuery load jobs. Use gzip for 'gcloud' infrastructure type.")
+
     loader.gcloud_project_id = args.gcloud_project_id
     loader.gcloud_storage_bucket_id = args.gcloud_storage_bucket_id
 
   loader.write_disposition = args.write_disposition
 
+  if args.incremental:
+    if args.write_disposition != 'append':
+      raise ValueError("incremental requires write_disposition 'append'. Overwrite deletes the saved checkpoint.")
+    loader.incremental = args.incremental
+
+  if args.follow:
+    if args.infra_type == 'gcloud':
+      raise ValueError("follow requires infra_type hadoop, since BigQuery tables can't be updated for new fields.")
+    if args.write_disposition != 'append':
+      raise ValueError("follow requires write_disposition 'append'.")
+    if args.schema_sample > 0:
+      raise ValueError("schema_sample can't be used with follow, since every batch would sample the whole collection.")
+    loader.follow_changes = args.follow
+    loader.follow_batch_size = args.follow_batch_size
+    loader.follow_batch_seconds = args.follow_batch_seconds
+
   if args.dest_table_name != None:
     loader.dw_table_name = args.dest_table_name
   else:
@@ -534,6 +1497,45 @@ def main():
   if args.use_mr:
     loader.use_mr = args.use_mr
 
+  if args.process_array == 'nested':
+    if args.infra_type != 'gcloud':
+      raise ValueError("nested process_array requires BigQuery (infra_type gcloud).")
+    if args.output_format != 'json':
+      raise ValueError("nested process_array requires json output_format.")
+
+  if args.output_format != 'json' and args.process_array != 'child_table':
+    raise ValueError("output_format %s requires child_table process_array. Avro / parquet columns are built for child tables." % args.output_format)
+
+  if args.output_format != 'json' and args.use_mr:
+    raise ValueError("output_format %s is local only. The MapReduce transform writes json." % args.output_format)
+
+  if args.schema_gen_mode == 'parallel' and args.use_mr:
+    raise ValueError("parallel schema_gen_mode is local only. Use mapper with use_mr.")
+
+  if args.stream_to_cs:
+    if not args.use_mr:
+      raise ValueError("stream_to_cs requires use_mr, since local schema generation and transform read from tmp_path.")
+    loader.stream_to_cs = args.stream_to_cs
+
+  loader.num_extract_workers = args.num_extract_workers
+  loader.unindexed_sort = args.unindexed_sort
+  loader.read_preference = args.read_preference
+  loader.compression = args.compression
+  loader.schema_gen_mode = args.schema_gen_mode
+  loader.schema_gen_workers = args.schema_gen_workers
+  loader.transform_workers = args.transform_workers
+  # fail before extraction if the hash function's module isn't installed
+  transform_util.get_hash_function(args.hash_function)
+  loader.hash_function = args.hash_function
+  loader.shard_key = args.shard_key
+  loader.output_format = args.output_format
+  loader.process_array = args.process_array
+  loader.schema_shape_cache_size = args.schema_shape_cache_size
+  loader.schema_sample = args.schema_sample
+  loader.schema_sample_ranges = args.schema_sample_ranges
+  loader.part_size_bytes = args.part_size_bytes
+  loader.part_max_records = args.part_max_records
+
   if args.policy_file != None:
     # open policy file
     policy_file = open(args.policy_file, "r")
@@ -16,6 +16,14 @@ import subprocess
 import os
 import random
 import time
+import gzip
+
+# file name extension and shell decompression command for each supported compression
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+DECOMPRESS_COMMANDS = {None: 'cat', 'gzip': 'gzip -dc', 'zstd': 'zstd -dcq'}
+
+# write buffer size for uncompressed files
+FILE_BUFFER_SIZE = 1024 * 1024
 
 # execute shell command
 def execute(command, ignore_error=False, retry=False, subpress_output=False):
@@ -92,3 +100,119 @@ def execute_and_read(command):
   return (return_code, stdout_lines, stderr_lines)
 
 
+# writable stream that pipes into the stdin of a shell command. close() waits for the command.
+class CommandWriter:
+
+  command = None
+  process = None
+
+  def __init__(self, command):
+    print 'Executing command: %s' % command
+    self.command = command
+    self.process = subprocess.Popen(command, stdin=subprocess.PIPE, shell=True, bufsize=FILE_BUFFER_SIZE)
+
+  def write(self, data):
+    self.process.stdin.write(data)
+
+  def flush(self):
+    self.process.stdin.flush()
+
+  def close(self):
+    if self.process is None:
+      return
+
+    self.process.stdin.close()
+    rc = self.process.wait()
+    self.process = None
+
+    if rc:
+      # Non-zero return code indicates an error.
+      raise Exception("Error executing command: %s" % self.command)
+
+
+# readable stream of the stdout of a shell command. close() waits for the command, so a failed
+# command (e.g. a truncated or corrupt compressed file) raises instead of reading partial data.
+class CommandReader:
+
+  command = None
+  process = None
+
+  def __init__(self, command):
+    print 'Executing command: %s' % command
+    self.command = command
+    self.process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, bufsize=FILE_BUFFER_SIZE)
+
+  def __iter__(self):
+    return iter(self.process.stdout)
+
+  def read(self, size=-1):
+    return self.process.stdout.read(size)
+
+  def readline(self):
+    return self.process.stdout.readline()
+
+  def close(self):
+    if self.process is None:
+      return
+
+    self.process.stdout.close()
+    rc = self.process.wait()
+    self.process = None
+
+    if rc:
+      # Non-zero return code indicates an error.
+      raise Exception("Error executing command: %s" % self.command)
+
+
+# wrap a writable stream in a gzip or zstd compressed stream. Closing it also closes the stream.
+class CompressedStreamWriter:
+
+  stream = None
+  compressed_stream = None
+
+  def __init__(self, stream, compression=None):
+    self.stream = stream
+    if compression == 'gzip':
+      self.compressed_stream = gzip.GzipFile(fileobj=stream, mode='wb')
+    elif compression == 'zstd':
+      import zstandard
+      self.compressed_stream = zstandard.ZstdCompressor().stream_writer(stream)
+    elif compression is not None:
+      raise ValueError('Unsupported compression %s' % compression)
+
+  def write(self, data):
+    if self.compressed_stream is not None:
+      self.compressed_stream.write(data)
+    else:
+      self.stream.write(data)
+
+  def close(self):
+    if self.compressed_stream is not None:
+      self.compressed_stream.close()
+    self.stream.close()
+
+
+# open file for writing, optionally wrapped in a gzip or zstd compressed stream
+def open_compressed_file(file_name, compression=None):
+  if compression == 'gzip':
+    return gzip.open(file_name, 'wb')
+  elif compression == 'zstd':
+    import zstandard
+    return zstandard.ZstdCompressor().stream_writer(open(file_name, 'wb'))
+  elif compression is None:
+    return open(file_name, 'w', FILE_BUFFER_SIZE)
+  else:
+    raise ValueError('Unsupported compression %s' % compression)
+
+
+# open file for reading, decompressing gzip or zstd files
+def open_compressed_input(file_name, compression=None):
+  if compression == 'gzip':
+    return gzip.open(file_name, 'rb')
+  elif compression == 'zstd':
+    # the zstandard module doesn't detect truncated frames, the zstd command exits with an error
+    return CommandReader("%s %s" % (DECOMPRESS_COMMANDS[compression], file_name))
+  elif compression is None:
+    return open(file_name, 'r', FILE_BUFFER_SIZE)
+  else:
+    raise ValueError('Unsupported compression %s' % compression)